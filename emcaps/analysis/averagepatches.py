@@ -12,20 +12,15 @@ from pathlib import Path
 import imageio.v3 as iio
 import hydra
 import numpy as np
-import pandas as pd
 from omegaconf import DictConfig, OmegaConf
 
 from emcaps import utils
+from emcaps.utils.patch_store import load_patches
 
 
 def get_enctype_patches(meta, enctype, patches_root, max_samples=None):
     enctypemeta = meta.loc[meta.enctype == enctype]
-    patches = []
-    for patch_entry in enctypemeta.itertuples():
-        raw_fname = patch_entry.patch_fname
-        raw_fname = patches_root / 'raw' / raw_fname
-        patch = iio.imread(raw_fname)
-        patches.append(patch)
+    patches = list(load_patches(patches_root, 'raw', enctypemeta.patch_fname))
     if max_samples is not None and len(patches) > max_samples:
         patches = random.sample(patches, max_samples)
     return patches
@@ -33,12 +28,10 @@ def get_enctype_patches(meta, enctype, patches_root, max_samples=None):
 
 def get_enctype_patches_by_img(meta, enctype, patches_root, max_samples=None):
     enctypemeta = meta.loc[meta.enctype == enctype]
+    all_patches = load_patches(patches_root, 'raw', enctypemeta.patch_fname)
     patches = {num: [] for num in enctypemeta.img_num.unique()}
-    for patch_entry in enctypemeta.itertuples():
-        raw_fname = patch_entry.patch_fname
-        raw_fname = patches_root / 'raw' / raw_fname
-        patch = iio.imread(raw_fname)
-        patches[patch_entry.img_num].append(patch)
+    for patch, img_num in zip(all_patches, enctypemeta.img_num):
+        patches[img_num].append(patch)
     for num in patches.keys():
         npatches = patches[num]
         if max_samples is not None and len(npatches) > max_samples:
@@ -66,7 +59,7 @@ def main(cfg: DictConfig) -> None:
     fh.setLevel(logging.DEBUG)
     logger.addHandler(fh)
 
-    patch_meta = pd.read_excel(f'{patches_root}/patchmeta.xlsx', sheet_name=0, index_col=0)
+    patch_meta = utils.read_table(f'{patches_root}/patchmeta.parquet', index_col=0)
     if not 'dataset_name' in patch_meta.columns:
         # Workaroud until 'dataset_name' is always present in patch meta: Populate from image-level source meta sheet
         patch_meta = utils.attach_dataset_name_column(patch_meta, src_sheet_path=cfg.sheet_path)
@@ -5,7 +5,7 @@ Based on https://napari.org/tutorials/segmentation/annotate_segmentation.html
 
 # TODO:
 # - Tiling prediction
-# - TTA
+# - Segmentation TTA
 
 import logging
 from pathlib import Path
@@ -29,6 +29,7 @@ from typing_extensions import Annotated
 from emcaps import utils
 from emcaps.utils import inference_utils as iu
 from emcaps.utils.colorlabel import color_dict_rgba
+from emcaps.utils.spatial_index import RegionIndex
 
 TMPPATH = '/tmp' if platform.system() == 'Darwin' else tempfile.gettempdir()
 
@@ -124,6 +125,7 @@ def make_regions_widget(
     Minimum_particle_size: Annotated[int, {"min": 0, "max": 1000, "step": 50}] = 60,
     Maximum_particle_size: Annotated[int, {"min": 1, "max": 2000, "step": 50}] = 1000,
     Minimum_circularity: Annotated[float, {"min": 0.0, "max": 1.0, "step": 0.1}] = 0.8,
+    Classifier_TTA: bool = False,
     Shape_type: Annotated[str, {'choices': ['ellipse', 'rectangle', 'dense']}] = 'dense',
     Relabel_inplace: bool = False,
     Table_output_path: str = get_default_xlsx_output_path(),
@@ -141,9 +143,10 @@ def make_regions_widget(
             minsize=Minimum_particle_size,
             maxsize=Maximum_particle_size,
             min_circularity=Minimum_circularity,
-            inplace_relabel=Relabel_inplace,
             allowed_classes=Allowed_classes,
-            return_relabeled_seg=True
+            return_relabeled_seg=True,
+            classifier_tta=Classifier_TTA,
+            properties=iu.RPROPS_DEFAULT,  # Everything that is needed for the xlsx table and the bbox shapes
         )
 
         nonlocal xlp
@@ -152,14 +155,17 @@ def make_regions_widget(
             xlp = Path(xlp)
         iu.save_properties_to_xlsx(properties=properties, xlsx_out_path=xlp)
 
-        # If inplace_relabel is true, this has modified the labels from the
-        # caller in place without napari suspecting anything, so we'll refresh manually
         if Relabel_inplace:
+            # Explicitly replace the data of the input labels layer with the class map
             for layer in napari.current_viewer().layers:
-                layer.refresh()
+                if isinstance(layer, napari.layers.Labels) and layer.data is Labels:
+                    layer.data = relabeled_seg
 
 
         majority_class_name = iu.compute_majority_class_name(class_preds=properties['class_id'])
+        # Enables fast lookup of the region under the cursor, see show_region_under_cursor()
+        region_index = RegionIndex.from_properties(properties)
+        layer_metadata = {'majority_class_name': majority_class_name, 'properties': properties, 'region_index': region_index}
 
         text_display =  f'Majority vote: {majority_class_name}'
         print(f'\n{text_display}')
@@ -171,6 +177,7 @@ def make_regions_widget(
                 name='Classification',
                 color=class_colors.copy(),
                 seed=0,
+                metadata=layer_metadata,
             )
             return (relabeled_seg, meta, 'labels')
             
@@ -192,7 +199,7 @@ def make_regions_widget(
             shape_type=Shape_type,
             properties=properties,
             text=text_parameters,
-            metadata={'majority_class_name': majority_class_name},
+            metadata=layer_metadata,
             features=properties['class_id'],
         )
 
@@ -243,6 +250,25 @@ def export_overlay(
     show_info(f'Exported overlay to {Output_path}')
 
 
+def show_region_under_cursor(viewer: napari.Viewer, event) -> None:
+    """Show class and measurements of the classified region under the cursor (on double click)"""
+    for layer in reversed(viewer.layers):
+        region_index = layer.metadata.get('region_index')
+        if region_index is None:
+            continue
+        position = np.round(layer.world_to_data(event.position))
+        hits = region_index.query_point(position)
+        if len(hits) == 0:
+            continue
+        properties = layer.metadata['properties']
+        infos = [
+            f'Region {properties["label"][i]}: {properties["class_name"][i]} (area: {properties["area"][i]}, radius2: {properties["radius2"][i]:.1f})'
+            for i in hits
+        ]
+        show_info('\n'.join(infos))
+        return
+
+
 def main():
 
     import argparse
@@ -274,6 +300,8 @@ def main():
         lab = iio.imread(lab_path)
         viewer.add_labels(lab > 0, name=lab_path.name, seed=0, color=class_colors.copy())
 
+    viewer.mouse_double_click_callbacks.append(show_region_under_cursor)
+
     viewer.window.add_dock_widget(make_seg_widget(), name='Segmentation', area='right')
     viewer.window.add_dock_widget(make_regions_widget(), name='Classification', area='right')
     # viewer.window.add_function_widget(render_overlay, name='Render overlay image', area='right')
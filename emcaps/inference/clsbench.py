@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmarks CPU throughput (patches/sec) of patch classifiers against their
+instance-level validation accuracy, to find lighter classifier variants that
+are suitable for production.
+
+Trained classifiers (see patchtrain.py) are measured for both throughput and
+accuracy, untrained architecture variants only for throughput.
+"""
+
+import time
+import logging
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+from emcaps import utils
+from emcaps.models.effnetv2 import build_effnetv2
+from emcaps.utils import inference_utils as iu
+from emcaps.utils.patch_store import load_patches
+
+
+logger = logging.getLogger('emcaps-clsbench')
+
+CPU = torch.device('cpu')
+
+
+def load_cpu_classifier(path_or_name: str) -> torch.jit.ScriptModule:
+    if path_or_name in iu.model_urls.keys():
+        path_or_name = iu.ub.grabdata(iu.model_urls[path_or_name], appname='emcaps')
+    return torch.jit.load(path_or_name, map_location=CPU).eval().float()
+
+
+def measure_throughput(model: torch.nn.Module, batch_size: int, num_batches: int, patch_shape=(49, 49)) -> float:
+    """Measure classifier throughput in patches/sec on CPU"""
+    inp = torch.rand(batch_size, 1, *patch_shape) * 2 - 1
+    with torch.inference_mode():
+        model(inp)  # Warmup
+        t0 = time.perf_counter()
+        for _ in range(num_batches):
+            model(inp)
+        dt = time.perf_counter() - t0
+    return batch_size * num_batches / dt
+
+
+def measure_accuracy(classifier: str, patches: np.ndarray, targets: np.ndarray, allowed_classes, batch_size: int, tta: bool = False) -> float:
+    """Instance-level accuracy, computed with the same classification code as patcheval.py"""
+    preds = iu.classify_patches(patches, classifier_variant=classifier, allowed_classes=allowed_classes, batch_size=batch_size, tta=tta)
+    return iu.instance_accuracy(preds, targets)
+
+
+@hydra.main(version_base='1.2', config_path='../conf', config_name='config')
+def main(cfg: DictConfig) -> None:
+    bcfg = cfg.clsbench
+    logger.info(f'Config:\n{OmegaConf.to_yaml(bcfg, resolve=True)}\n')
+    if bcfg.num_threads > 0:
+        torch.set_num_threads(bcfg.num_threads)
+
+    ds_sheet_path = Path(bcfg.patch_ds_sheet)
+    patches_path = ds_sheet_path.parent
+    meta = utils.read_table(ds_sheet_path, index_col=0)
+    vmeta = meta.loc[meta.validation == True]
+    patches = load_patches(patches_path, 'nobg', vmeta.patch_fname)
+    targets = iu.patch_targets(vmeta.enctype)
+    allowed_classes = cfg.patcheval.constrain_classifier
+
+    results = []
+    for classifier in bcfg.classifiers:
+        model = load_cpu_classifier(classifier)
+        results.append({
+            'model': classifier,
+            'trained': True,
+            'patches_per_sec': measure_throughput(model, bcfg.batch_size, bcfg.num_batches),
+            'accuracy': measure_accuracy(classifier, patches, targets, allowed_classes, bcfg.batch_size, tta=cfg.patcheval.tta),
+            'num_params': sum(p.numel() for p in model.parameters()),
+        })
+        logger.info(results[-1])
+
+    for variant in bcfg.variants:
+        model = build_effnetv2(variant, in_c=1, num_classes=8).eval()
+        results.append({
+            'model': variant,
+            'trained': False,
+            'patches_per_sec': measure_throughput(model, bcfg.batch_size, bcfg.num_batches),
+            'accuracy': np.nan,
+            'num_params': sum(p.numel() for p in model.parameters()),
+        })
+        logger.info(results[-1])
+
+    results = pd.DataFrame(results)
+    out_path = Path(bcfg.out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    results.to_excel(out_path, index=False)
+    logger.info(f'Wrote results to {out_path}:\n{results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,6 @@ from pathlib import Path
 
 import hydra
 import logging
-import imageio.v3 as iio
 import matplotlib.pyplot as plt
 import torch
 import numpy as np
@@ -26,6 +25,12 @@ elektronn3.select_mpl_backend('auto')
 from emcaps.analysis.cf_matrix import plot_confusion_matrix
 from emcaps import utils
 from emcaps.utils import inference_utils as iu
+from emcaps.utils.cascade import RadialProfilePrefilter, compare_cascade
+from emcaps.utils.patch_store import load_patches
+
+
+def load_nobg_patches(meta: pd.DataFrame, patches_path: Path) -> np.ndarray:
+    return load_patches(patches_path, 'nobg', meta.patch_fname).astype(np.float32)
 
 
 @hydra.main(version_base='1.2', config_path='../conf', config_name='config')
@@ -69,7 +74,7 @@ def main(cfg: DictConfig) -> None:
 
     GROUPKEY = 'enctype'
 
-    meta = pd.read_excel(ds_sheet_path, 0, index_col=0)
+    meta = utils.read_table(ds_sheet_path, index_col=0)
 
     # Metadata filtered to only include validation patches
     vmeta = meta.loc[meta.validation == True]
@@ -79,6 +84,18 @@ def main(cfg: DictConfig) -> None:
         # Workaroud until 'dataset_name' is always present in patch meta: Populate from image-level source meta sheet
         vmeta = utils.attach_dataset_name_column(vmeta, src_sheet_path=cfg.sheet_path)
 
+    cascade_margin = cfg.patcheval.cascade_margin
+    prefilter = None
+    cascade_reports = {}
+    if cascade_margin is not None:
+        # Fit the cheap first cascade stage on the training patches
+        tmeta = meta.loc[meta.train == True]
+        logger.info(f'Fitting cascade prefilter on {tmeta.shape[0]} training patches')
+        tpatches = load_nobg_patches(tmeta, patches_path)
+        ttargets = iu.patch_targets(tmeta.enctype)
+        prefilter = RadialProfilePrefilter(margin=cascade_margin).fit(tpatches, ttargets)
+        prefilter.save(eval_path / 'prefilter.pkl')
+
     dataset_names = vmeta.dataset_name.unique().tolist()
     # Prepend special dataset name that instructs to use all datasets
     dataset_names = ['all_datasets'] + dataset_names
@@ -91,6 +108,27 @@ def main(cfg: DictConfig) -> None:
 
         logger.info(f'\n== Patch selection: {dataset_name}  ({_i} / {len(dataset_names)}) ==')
 
+        cached_preds = None
+        if prefilter is not None:
+            # Classify all patches once with both CNN-only and cascade classification and report the differences.
+            # The cascade predictions are then reused for all splits below.
+            report, cascade_preds = compare_cascade(
+                patches=load_nobg_patches(dvmeta, patches_path),
+                targets=iu.patch_targets(dvmeta.enctype),
+                prefilter=prefilter,
+                classifier_variant=classifier_path,
+                allowed_classes=constrain_classifier,
+                tta=cfg.patcheval.tta,
+            )
+            cached_preds = dict(zip(dvmeta.patch_fname, cascade_preds))
+            cascade_reports[dataset_name] = report
+            logger.info(
+                f'Cascade: escalated {report["escalation_rate"] * 100:.1f}% of {report["n_patches"]} patches, '
+                f'speedup {report["speedup"]:.2f}x ({report["t_cnn"]:.2f}s -> {report["t_cascade"]:.2f}s), '
+                f'accuracy {report["accuracy_cnn"] * 100:.2f}% -> {report["accuracy_cascade"] * 100:.2f}% '
+                f'({report["accuracy_diff"] * 100:+.2f}%)'
+            )
+
         all_targets = []
         all_preds = []
 
@@ -151,12 +189,17 @@ def main(cfg: DictConfig) -> None:
                 targets = []
                 pred_labels = []
                 target_labels = []
-                for patch_entry in gdvmeta.itertuples():
+                if cached_preds is None:
+                    gpreds = iu.classify_patches(
+                        load_nobg_patches(gdvmeta, patches_path),
+                        classifier_variant=classifier_path, allowed_classes=constrain_classifier, tta=cfg.patcheval.tta
+                    )
+                for _j, patch_entry in enumerate(gdvmeta.itertuples()):
                     raw_fname = patch_entry.patch_fname
-                    nobg_fpath = patches_path / 'nobg' / raw_fname.replace('raw', 'nobg')
-                    patch = iio.imread(nobg_fpath).astype(np.float32)
-
-                    pred = iu.classify_patch(patch, classifier_variant=classifier_path, allowed_classes=constrain_classifier)
+                    if cached_preds is not None:
+                        pred = cached_preds[raw_fname]
+                    else:
+                        pred = int(gpreds[_j])
 
                     pred_label = utils.CLASS_NAMES[pred]
 
@@ -211,9 +254,7 @@ def main(cfg: DictConfig) -> None:
 
         all_preds = np.stack(all_preds)
         all_targets = np.stack(all_targets)
-        instance_n_correct = np.sum(all_targets == all_preds)
-        instance_n_total = all_targets.shape[0]
-        instance_avg_accuracy = instance_n_correct / instance_n_total
+        instance_avg_accuracy = iu.instance_accuracy(all_preds, all_targets)
         logger.info(f'Instance-level average accuracy: {instance_avg_accuracy * 100:.2f}%')
 
         full_group_targets = np.stack(full_group_targets)
@@ -243,6 +284,10 @@ def main(cfg: DictConfig) -> None:
 
         # import IPython ; IPython.embed(); raise SystemExit
 
+    if cascade_reports:
+        cascade_reports = pd.DataFrame.from_dict(cascade_reports, orient='index')
+        cascade_reports.to_excel(f'{eval_path}/cascade_report.xlsx', index_label='dataset_name')
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
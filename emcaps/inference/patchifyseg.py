@@ -7,30 +7,33 @@ around particle centroids
 """
 import os
 from pathlib import Path
-from typing import NamedTuple
+from typing import Iterable, Optional, Sequence
 import shutil
 import logging
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import imageio.v3 as iio
 import tqdm
 import pandas as pd
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 
 from PIL import Image, ImageDraw
 
 from scipy import ndimage
-from skimage import morphology as sm
-from skimage import measure
 import torch.backends.cudnn
 
 from elektronn3.inference import Predictor
 from elektronn3.data import transforms
 
-from emcaps.utils.patch_utils import measure_outer_disk_radius, concentric_average, concentric_max
+from emcaps.utils.patch_utils import concentric_averages
 from emcaps import utils
 from emcaps.utils import inference_utils as iu
+from emcaps.utils.patch_store import PATCH_KINDS, convert_png_dataset, remove_patch_store
+from emcaps.utils.region_utils import iter_region_chunks, select_candidate_regions
 
 
 def eul(paths):
@@ -62,23 +65,24 @@ def image_grid(imgs, rows, cols, enable_grid_lines=True, text_color=255):
 
 
 
-class PatchMeta(NamedTuple):
-    # patch_id: int  # Auto-assigned as row number index from pandas
-    patch_fname: str
-    img_num: int
-    enctype: str
-    dataset_name: str
-    centroid_x: int
-    centroid_y: int
-    corner_x: int
-    corner_y: int
-    train: bool
-    validation: bool
-    radius2: float = np.nan
-    radius2_dilated: float = np.nan
-    area: float = np.nan
-    area_dilated: float = np.nan
-    circularity: float = np.nan
+# Columns of the patch meta table and their types. The patch_id is the table index.
+PATCHMETA_DTYPES = {
+    'patch_fname': 'string',
+    'img_num': 'int64',
+    'enctype': 'string',
+    'dataset_name': 'string',
+    'centroid_x': 'int64',
+    'centroid_y': 'int64',
+    'corner_x': 'int64',
+    'corner_y': 'int64',
+    'train': 'bool',
+    'validation': 'bool',
+    'radius2': 'float64',
+    'radius2_dilated': 'float64',
+    'area': 'int64',
+    'area_dilated': 'int64',
+    'circularity': 'float64',  # NaN if patchifyseg.min_circularity == 0
+}
 
 
 torch.backends.cudnn.benchmark = True
@@ -87,61 +91,33 @@ np.random.seed(0)
 
 
 
-@hydra.main(version_base='1.2', config_path='../conf', config_name='config')
-def main(cfg: DictConfig) -> None:
-    pre_predict_transform = transforms.Compose([
-        transforms.Normalize(mean=cfg.dataset_mean, std=cfg.dataset_std)
-    ])
-    thresh = cfg.patchifyseg.thresh
-
-    N_EVAL_SAMPLES = 30
-    EC_REGION_RADIUS = cfg.patchifyseg.ec_region_radius
-    EC_MIN_AREA = cfg.minsize
-    EC_MAX_AREA = (2 * EC_REGION_RADIUS)**2
-    USE_GT = cfg.patchifyseg.use_gt
-    DILATE_MASKS_BY = cfg.patchifyseg.dilate_masks_by
-    MIN_CIRCULARITY = cfg.patchifyseg.min_circularity
-    ALL_VALIDATION = cfg.patchifyseg.all_validation
+logger = logging.getLogger('emcaps-patchifyseg')
 
-    # Add 1 to high region coordinate in order to arrive at an odd number of pixels in each dimension
-    EC_REGION_ODD_PLUS1 = 1
-
-    class_groups_to_include = [
-        'simple_hek',
-        'dro',
-        'mice',
-        'qttm',
-        'multi',
-    ]
+# Add 1 to high region coordinate in order to arrive at an odd number of pixels in each dimension
+EC_REGION_ODD_PLUS1 = 1
 
-    # root_path = Path('/wholebrain/scratch/mdraw/tum/Single-table_database/')
-    sheet_path = Path(cfg.sheet_path)
-    isplitdata_root = Path(cfg.isplit_data_path)
 
-    img_paths = []
-    for lp in isplitdata_root.rglob(f'*_{cfg.label_name}.png'):
-        # Indirectly find img paths via label paths: raw can be always found by stripping the "_encapsulins" substring
-        img_path = lp.with_stem(lp.stem.removesuffix(f'_{cfg.label_name}'))
-        # Only include images that can be found in cfg.tr_group, to stay consistent with segmentation training/validation
-        if utils.is_in_data_group(path_or_num=img_path, group_name=cfg.tr_group, sheet_path=sheet_path):
-            img_paths.append(img_path)
-
-    patch_out_path: str = os.path.expanduser(cfg.patchifyseg.patch_out_path)
-    segmenter = cfg.patchifyseg.segmenter
-
-    # Create output directories
-    for p in [patch_out_path, f'{patch_out_path}/raw', f'{patch_out_path}/mask', f'{patch_out_path}/samples', f'{patch_out_path}/nobg', f'{patch_out_path}/cavg']:
-        os.makedirs(p, exist_ok=True)
-
-    # Set up logging
-    logger = logging.getLogger('emcaps-patchifyseg')
+def setup_logging(patch_out_path: str) -> None:
     logger.setLevel(logging.DEBUG)
     fh = logging.FileHandler(f'{patch_out_path}/patchify.log')
     fh.setLevel(logging.DEBUG)
     logger.addHandler(fh)
 
+
+def resolve_segmenter(cfg: DictConfig) -> str:
+    """Name of the segmenter that is actually used (resolves the special value 'auto')"""
+    segmenter = cfg.patchifyseg.segmenter
     if segmenter == 'auto':
         segmenter = f'unet_{cfg.tr_group}_{cfg.v}'
+    return segmenter
+
+
+def build_predictor(cfg: DictConfig) -> Predictor:
+    pre_predict_transform = transforms.Compose([
+        transforms.Normalize(mean=cfg.dataset_mean, std=cfg.dataset_std)
+    ])
+    segmenter = resolve_segmenter(cfg)
+    if cfg.patchifyseg.segmenter == 'auto':
         logger.info(f'Using default segmenter {segmenter} based on other config values')
         segmenter_model = iu.get_model(segmenter)
     elif segmenter == 'randomizer':
@@ -159,167 +135,229 @@ def main(cfg: DictConfig) -> None:
         augmentations=cfg.patchifyseg.tta_num,
         apply_softmax=True,
     )
+    return predictor
 
 
-    logger.info(f'Using data from {isplitdata_root}')
-    logger.info(f'Using meta spreadsheet {sheet_path}')
-    logger.info(f'Writing outputs to {patch_out_path}')
+def patchify_image(cfg: DictConfig, predictor: Optional[Predictor], img_path: Path, staging_dir: Path, progress: bool = True) -> pd.DataFrame:
+    """Segment one image and write all of its particle patches to staging_dir.
 
-    included = []
-    for cgrp in class_groups_to_include:
-        cgrp_classes = utils.CLASS_GROUPS[cgrp]
-        logger.info(f'Including class group {cgrp}, containing classes {cgrp_classes}')
-        included.extend(utils.CLASS_GROUPS[cgrp])
-    DATA_SELECTION = included
+    Patches are written as {staging_dir}/{kind}/{i:06d}.png, with i being the in-image patch index.
+    The rows of the returned patch meta table (in the same order) have an empty patch_fname, the final
+    patch ids and file names are assigned by merge_staged_patches()."""
+    sheet_path = Path(cfg.sheet_path)
+    isplitdata_root = Path(cfg.isplit_data_path)
+    thresh = cfg.patchifyseg.thresh
+    EC_REGION_RADIUS = cfg.patchifyseg.ec_region_radius
+    EC_MIN_AREA = cfg.minsize
+    EC_MAX_AREA = (2 * EC_REGION_RADIUS)**2
+    USE_GT = cfg.patchifyseg.use_gt
+    DILATE_MASKS_BY = cfg.patchifyseg.dilate_masks_by
+    MIN_CIRCULARITY = cfg.patchifyseg.min_circularity
+    ALL_VALIDATION = cfg.patchifyseg.all_validation
+    BORDER_MODE = cfg.patchifyseg.border_mode
 
-    patchmeta = []
+    logger.debug(str(img_path))
+    for kind in PATCH_KINDS:
+        os.makedirs(staging_dir / kind, exist_ok=True)
+
+    imgmeta = utils.get_meta_row(img_path, sheet_path=sheet_path)
+
+    inp = np.array(iio.imread(img_path), dtype=np.float32)[None][None]  # (N=1, C=1, H, W)
+    raw = inp[0][0]
+    if USE_GT:
+        label_path = img_path.with_name(f'{img_path.stem}_{cfg.label_name}.png')
+        label = iio.imread(label_path).astype(np.int64)
+        mask = label
+    else:
+        out = predictor.predict(inp)
+        out = out.numpy()
+
+        assert out.shape[1] == 2
+        cout = out[0, 1]
+        cout = (cout * 255.).astype(np.uint8)
+        mask = cout > thresh
 
-    patch_id = 0  # Incremented below for each patch written to disk
-
-    for img_path in tqdm.tqdm(img_paths, position=0, desc='Images', dynamic_ncols=True):
-        logger.debug(str(img_path))
-
-        imgmeta = utils.get_meta_row(img_path, sheet_path=sheet_path)
-
-        inp = np.array(iio.imread(img_path), dtype=np.float32)[None][None]  # (N=1, C=1, H, W)
-        raw = inp[0][0]
-        if USE_GT:
-            label_path = img_path.with_name(f'{img_path.stem}_{cfg.label_name}.png')
-            label = iio.imread(label_path).astype(np.int64)
-            mask = label
-        else:
-            out = predictor.predict(inp)
-            out = out.numpy()
-
-            assert out.shape[1] == 2
-            cout = out[0, 1]
-            cout = (cout * 255.).astype(np.uint8)
-            mask = cout > thresh
-
-        mask = ndimage.binary_fill_holes(mask).astype(mask.dtype)
-
-        img_num = imgmeta.num
-        dataset_name = imgmeta.get('Dataset Name', '')
-
-        if ALL_VALIDATION:
-            is_validation = True
-        else:
-            is_validation = '_val' in img_path.stem
-        role = 'val' if is_validation else 'trn'
-        is_train = not is_validation
-
-        cc, n_comps = ndimage.label(mask)
-
-        rprops = measure.regionprops(cc, raw)
-
-        for rp in tqdm.tqdm(rprops, position=1, leave=False, desc='Patches'):
-            centroid = np.round(rp.centroid).astype(np.int64)  # Note: This centroid is in the global coordinate frame
-            if rp.area < EC_MIN_AREA or rp.area > EC_MAX_AREA:
-                logger.info(f'Skipping: area size {rp.area} not within [{EC_MIN_AREA}, {EC_MAX_AREA}]')
-                continue  # Too small or too big (-> background component?) to be a normal particle
-            circularity = np.nan
-            if MIN_CIRCULARITY > 0:
-                circularity = iu.calculate_circularity(rp.perimeter, rp.area)
-                if circularity < MIN_CIRCULARITY:
-                    logger.info(f'Skipping: circularity {circularity} below {MIN_CIRCULARITY}')
-                    continue  # Not circular enough (probably a false merger)
-                circularity = np.round(circularity, 2)  # Round for more readable logging
-
-            lo = centroid - EC_REGION_RADIUS
-            hi = centroid + EC_REGION_RADIUS + EC_REGION_ODD_PLUS1
-            if np.any(lo < 0) or np.any(hi > raw.shape):
-                logger.info(f'Skipping: region touches border')
-                continue  # Too close to image border
-
-            xslice = slice(lo[0], hi[0])
-            yslice = slice(lo[1], hi[1])
-
-            # Get enctype for specific position (for supporting multi-class images)
-            enctype = utils.get_isplit_enctype(path=img_path, sheet_path=sheet_path, pos=tuple(centroid), isplitdata_root=isplitdata_root, role=role)
-
-            if enctype == '?':
-                logger.info(f'Skipping patch, can\'t determine local enctype: image {img_num=}, {role=}, pos={centroid}')
-                continue
-
-            raw_patch = raw[xslice, yslice]
-            # mask_patch = mask[xslice, yslice]
-            # For some reason mask[xslice, yslice] does not always contain nonzero values, but cc at the same slice does.
-            # So we rebuild the mask at the region slice by comparing cc to 0
-            mask_patch = cc[xslice, yslice] > 0
-
-            # Eliminate coinciding masks from other particles that can overlap with this region (this can happen because we slice the mask_patch from the global mask)
-            _mask_patch_cc, _ = ndimage.label(mask_patch)
-            # Assuming convex particles, the center pixel is always on the actual mask region of interest.
-            _local_center = np.round(np.array(mask_patch.shape) / 2).astype(np.int64)
-            _mask_patch_centroid_label = _mask_patch_cc[tuple(_local_center)]
-            # All mask_patch pixels that don't share the same cc label as the centroid pixel are set to 0
-            mask_patch[_mask_patch_cc != _mask_patch_centroid_label] = 0
-
-            if mask_patch.sum() == 0:
-                # No positive pixel in mask -> skip this one
-                logger.info(f'Skipping: no particle mask in region')
-                # TODO: Why does this happen although we're iterating over regionprops from mask?
-                # (Only happens if using `mask_patch = mask[xslice, yslice]`. Workaround: `Use mask_patch = cc[xslice, yslice] > 0`)
-                continue
-
-            area = int(np.sum(mask_patch))
-            radius2 = np.round(measure_outer_disk_radius(mask_patch, discrete=False), 1)
-
-            # Enlarge masks because we don't want to risk losing perimeter regions
-            if DILATE_MASKS_BY > 0:
-                disk = sm.disk(DILATE_MASKS_BY)
-                # mask_patch = ndimage.binary_dilation(mask_patch, iterations=DILATE_MASKS_BY)
-                mask_patch = sm.binary_dilation(mask_patch, footprint=disk)
-
-            # Measure again after mask dilation
-            area_dilated = int(np.sum(mask_patch))
-            radius2_dilated = np.round(measure_outer_disk_radius(mask_patch, discrete=False), 1)
-
-            # Raw patch with background erased via mask
-            nobg_patch = raw_patch.copy()
-            nobg_patch[mask_patch == 0] = 0
-
-            # Concentric average image
-            cavg_patch = concentric_average(raw_patch)
-
-            raw_patch_fname = f'{patch_out_path}/raw/raw_patch_{patch_id:06d}.png'
-            mask_patch_fname = f'{patch_out_path}/mask/mask_patch_{patch_id:06d}.png'
-            nobg_patch_fname = f'{patch_out_path}/nobg/nobg_patch_{patch_id:06d}.png'
-            cavg_patch_fname = f'{patch_out_path}/cavg/cavg_patch_{patch_id:06d}.png'
-
-            patchmeta.append(PatchMeta(
-                # patch_id=patch_id,
-                patch_fname=os.path.basename(raw_patch_fname),
-                img_num=img_num,
-                dataset_name=dataset_name,
-                enctype=enctype,
-                centroid_y=centroid[0],
-                centroid_x=centroid[1],
-                corner_y=lo[0],
-                corner_x=lo[1],
-                train=is_train,
-                validation=is_validation,
-                radius2=radius2,
-                radius2_dilated=radius2_dilated,
-                area=area,
-                area_dilated=area_dilated,
-                circularity=circularity,
-            ))
-
-            iio.imwrite(raw_patch_fname, raw_patch.astype(np.uint8))
-            iio.imwrite(mask_patch_fname, mask_patch.astype(np.uint8) * 255)
-            iio.imwrite(nobg_patch_fname, nobg_patch.astype(np.uint8))
-            iio.imwrite(cavg_patch_fname, cavg_patch.astype(np.uint8))
-            patch_id += 1
-
-
-    patchmeta = pd.DataFrame(
-        patchmeta,
-        columns=PatchMeta._fields,
+    mask = ndimage.binary_fill_holes(mask).astype(mask.dtype)
+
+    img_num = imgmeta.num
+    dataset_name = imgmeta.get('Dataset Name', '')
+
+    if ALL_VALIDATION:
+        is_validation = True
+    else:
+        is_validation = '_val' in img_path.stem
+    role = 'val' if is_validation else 'trn'
+    is_train = not is_validation
+
+    cc, n_comps = ndimage.label(mask)
+
+    # Size, circularity and border filtering is done for all regions at once, only the remaining ones are patchified
+    rstats, region_indices = select_candidate_regions(
+        cc, n_comps, min_area=EC_MIN_AREA, max_area=EC_MAX_AREA, min_circularity=MIN_CIRCULARITY,
+        ec_region_radius=EC_REGION_RADIUS, odd_plus1=EC_REGION_ODD_PLUS1, border_mode=BORDER_MODE,
+    )
+    region_chunks = iter_region_chunks(
+        raw, cc, rstats, region_indices, ec_region_radius=EC_REGION_RADIUS, odd_plus1=EC_REGION_ODD_PLUS1,
+        dilate_masks_by=DILATE_MASKS_BY, border_mode=BORDER_MODE,
     )
-    patchmeta = patchmeta.convert_dtypes()
-    patchmeta = patchmeta.astype({'img_num': int})  # Int64
-    patchmeta.to_excel(f'{patch_out_path}/patchmeta.xlsx', index_label='patch_id')
+
+    chunk_metas = []
+    n_patches = 0
+    pbar = tqdm.tqdm(total=len(region_indices), position=1, leave=False, desc='Patches', disable=not progress)
+    for chunk in region_chunks:
+        # Concentric average images of the whole chunk
+        cavg_patches = concentric_averages(chunk.raw_patch)
+        # Get enctypes at all centroid positions of the chunk (for supporting multi-class images)
+        enctypes = utils.get_isplit_enctypes(path=img_path, sheet_path=sheet_path, positions=chunk.centroid, isplitdata_root=isplitdata_root, role=role)
+        pbar.update(len(chunk.index))
+        keep = enctypes != '?'
+        for centroid in chunk.centroid[~keep]:
+            logger.info(f'Skipping patch, can\'t determine local enctype: image {img_num=}, {role=}, pos={centroid}')
+
+        # Columns of all kept patches of the chunk. Note: corners can be negative if BORDER_MODE is set
+        chunk_metas.append(pd.DataFrame({
+            'patch_fname': '',  # Assigned in merge_staged_patches()
+            'img_num': img_num,
+            'enctype': enctypes[keep],
+            'dataset_name': dataset_name,
+            'centroid_x': chunk.centroid[keep, 1],
+            'centroid_y': chunk.centroid[keep, 0],
+            'corner_x': chunk.corner[keep, 1],
+            'corner_y': chunk.corner[keep, 0],
+            'train': is_train,
+            'validation': is_validation,
+            'radius2': chunk.radius2[keep],
+            'radius2_dilated': chunk.radius2_dilated[keep],
+            'area': chunk.area[keep],
+            'area_dilated': chunk.area_dilated[keep],
+            'circularity': chunk.circularity[keep],
+        }, columns=list(PATCHMETA_DTYPES)))
+
+        for j in np.flatnonzero(keep):
+            fname = f'{n_patches:06d}.png'
+            iio.imwrite(staging_dir / 'raw' / fname, chunk.raw_patch[j].astype(np.uint8))
+            iio.imwrite(staging_dir / 'mask' / fname, chunk.dilated_mask_patch[j].astype(np.uint8) * 255)
+            iio.imwrite(staging_dir / 'nobg' / fname, chunk.nobg_patch[j].astype(np.uint8))
+            iio.imwrite(staging_dir / 'cavg' / fname, cavg_patches[j].astype(np.uint8))
+            n_patches += 1
+    pbar.close()
+    return make_patchmeta_table(chunk_metas)
+
+
+def make_patchmeta_table(frames: Sequence[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate patch meta frames to one table with the column types of PATCHMETA_DTYPES"""
+    if len(frames) == 0:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in PATCHMETA_DTYPES.items()})
+    return pd.concat(frames).astype(PATCHMETA_DTYPES)
+
+
+def merge_staged_patches(staged: Iterable[tuple[Path, pd.DataFrame]], patch_out_path: str, first_patch_id: int = 0) -> list[pd.DataFrame]:
+    """Move staged patches of all images to their final locations and return the patch meta table of each image.
+
+    Patch ids are assigned in order of staged (image order), then by in-image order, so
+    the resulting ids are independent of the order in which images were processed."""
+    patchmeta = []
+    patch_id = first_patch_id
+    for staging_dir, image_patchmeta in staged:
+        patch_ids = np.arange(patch_id, patch_id + len(image_patchmeta))
+        for i, pid in enumerate(patch_ids):
+            for kind in PATCH_KINDS:
+                os.replace(staging_dir / kind / f'{i:06d}.png', f'{patch_out_path}/{kind}/{kind}_patch_{pid:06d}.png')
+        image_patchmeta = image_patchmeta.set_axis(patch_ids)
+        image_patchmeta['patch_fname'] = pd.array([f'raw_patch_{pid:06d}.png' for pid in patch_ids], dtype='string')
+        patchmeta.append(image_patchmeta)
+        patch_id += len(patch_ids)
+        shutil.rmtree(staging_dir)
+    return patchmeta
+
+
+# Per-process state of patchify worker processes, see _init_worker()
+_worker_cfg: Optional[DictConfig] = None
+_worker_predictor: Optional[Predictor] = None
+
+
+def _init_worker(cfg: DictConfig) -> None:
+    global _worker_cfg, _worker_predictor
+    _worker_cfg = cfg
+    setup_logging(os.path.expanduser(cfg.patchifyseg.patch_out_path))
+    _worker_predictor = None if cfg.patchifyseg.use_gt else build_predictor(cfg)
+
+
+def _patchify_image_in_worker(img_path: Path, staging_dir: Path) -> pd.DataFrame:
+    return patchify_image(_worker_cfg, _worker_predictor, img_path, staging_dir, progress=False)
+
+
+def patchify_images(cfg: DictConfig, img_paths: Sequence[Path], patch_out_path: str, first_patch_id: int = 0) -> list[pd.DataFrame]:
+    """Patchify all images, optionally in cfg.patchifyseg.num_workers parallel worker processes.
+
+    Returns the patch meta table of each image, with consecutive patch ids starting at first_patch_id.
+    Outputs (patch files and meta entries) are identical for all numbers of workers."""
+    num_workers = cfg.patchifyseg.num_workers
+    staging_root = Path(patch_out_path) / 'staging'
+    staging_dirs = [staging_root / f'{i:05d}' for i in range(len(img_paths))]
+    if num_workers == 0:
+        predictor = None if cfg.patchifyseg.use_gt else build_predictor(cfg)
+        staged = (
+            (staging_dir, patchify_image(cfg, predictor, img_path, staging_dir))
+            for img_path, staging_dir in zip(tqdm.tqdm(img_paths, position=0, desc='Images', dynamic_ncols=True), staging_dirs)
+        )
+        patchmeta = merge_staged_patches(staged, patch_out_path, first_patch_id=first_patch_id)
+    else:
+        logger.info(f'Patchifying {len(img_paths)} images in {num_workers} worker processes')
+        # Spawn (don't fork) workers so each of them can safely initialize its own CUDA context
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=_init_worker, initargs=(cfg,)) as executor:
+            results = executor.map(_patchify_image_in_worker, img_paths, staging_dirs)
+            results = tqdm.tqdm(results, total=len(img_paths), position=0, desc='Images', dynamic_ncols=True)
+            # Results are yielded in image order, so ids don't depend on which worker finishes first
+            patchmeta = merge_staged_patches(zip(staging_dirs, results), patch_out_path, first_patch_id=first_patch_id)
+    shutil.rmtree(staging_root, ignore_errors=True)
+    return patchmeta
+
+
+def source_hash(img_path: Path, label_path: Path) -> str:
+    """SHA-1 content hash of a source image and its label file"""
+    h = hashlib.sha1()
+    for path in [img_path, label_path]:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def settings_hash(cfg: DictConfig) -> str:
+    """SHA-1 hash of all settings that influence patch contents (patches created with different settings can't be combined)"""
+    settings = {k: v for k, v in cfg.patchifyseg.items() if k not in ['patch_out_path', 'num_workers', 'incremental', 'patch_store', 'xlsx_export']}
+    # The resolved segmenter name changes with tr_group and v if segmenter is 'auto'. tr_group also selects the images.
+    settings.update(segmenter=resolve_segmenter(cfg), tr_group=cfg.tr_group)
+    settings.update(minsize=cfg.minsize, label_name=cfg.label_name, dataset_mean=cfg.dataset_mean, dataset_std=cfg.dataset_std)
+    return hashlib.sha1(OmegaConf.to_yaml(settings, resolve=True).encode()).hexdigest()
+
+
+def make_sources_table(img_paths: Sequence[Path], hashes: Sequence[str], per_image_patchmeta: Sequence[pd.DataFrame], first_patch_id: int, settings_sha1: str) -> pd.DataFrame:
+    """Source manifest: which patch ids (first_patch_id, n_patches) were created from which source image version"""
+    n_patches = np.array([len(image_patchmeta) for image_patchmeta in per_image_patchmeta], dtype=np.int64)
+    first_patch_ids = first_patch_id + np.cumsum(n_patches) - n_patches
+    return pd.DataFrame({
+        'img_path': [str(p) for p in img_paths],
+        'sha1': list(hashes),
+        'first_patch_id': first_patch_ids,
+        'n_patches': n_patches,
+        'settings_sha1': settings_sha1,
+    })
+
+
+def remove_patches(patch_out_path: str, patch_ids: Iterable[int]) -> None:
+    for patch_id in patch_ids:
+        for kind in PATCH_KINDS:
+            Path(f'{patch_out_path}/{kind}/{kind}_patch_{patch_id:06d}.png').unlink(missing_ok=True)
+
+
+def write_sampling_tables(patchmeta: pd.DataFrame, patch_out_path: str, n_eval_samples: int = 30, xlsx_export: bool = False) -> None:
+    """Write the derived sampling tables and sample images (balanced patchmeta_traintest.parquet, samples_gt.xlsx,
+    samples_blind.xlsx, samples/ and samples_grid.png) of a patch dataset.
+
+    The samples_* tables are meant for human evaluation and are therefore always written as XLSX."""
+    N_EVAL_SAMPLES = n_eval_samples
 
     # individual_enctypes = patchmeta.enctype.unique()
     individual_enctypes = utils.CLASS_GROUPS['simple_hek']
@@ -360,7 +398,7 @@ def main(cfg: DictConfig) -> None:
 
     all_samples = samples
     all_samples = all_samples.convert_dtypes()
-    all_samples.to_excel(f'{patch_out_path}/patchmeta_traintest.xlsx', index_label='patch_id')
+    utils.write_table(all_samples, f'{patch_out_path}/patchmeta_traintest.parquet', index_label='patch_id', xlsx_export=xlsx_export)
 
     print('Done with all_samples')
 
@@ -385,5 +423,102 @@ def main(cfg: DictConfig) -> None:
     grid.save(f'{patch_out_path}/samples_grid.png')
 
 
+
+@hydra.main(version_base='1.2', config_path='../conf', config_name='config')
+def main(cfg: DictConfig) -> None:
+    class_groups_to_include = [
+        'simple_hek',
+        'dro',
+        'mice',
+        'qttm',
+        'multi',
+    ]
+
+    # root_path = Path('/wholebrain/scratch/mdraw/tum/Single-table_database/')
+    sheet_path = Path(cfg.sheet_path)
+    isplitdata_root = Path(cfg.isplit_data_path)
+
+    img_paths = []
+    for lp in isplitdata_root.rglob(f'*_{cfg.label_name}.png'):
+        # Indirectly find img paths via label paths: raw can be always found by stripping the "_encapsulins" substring
+        img_path = lp.with_stem(lp.stem.removesuffix(f'_{cfg.label_name}'))
+        # Only include images that can be found in cfg.tr_group, to stay consistent with segmentation training/validation
+        if utils.is_in_data_group(path_or_num=img_path, group_name=cfg.tr_group, sheet_path=sheet_path):
+            img_paths.append(img_path)
+
+    patch_out_path: str = os.path.expanduser(cfg.patchifyseg.patch_out_path)
+
+    # Create output directories
+    for p in [patch_out_path, f'{patch_out_path}/samples'] + [f'{patch_out_path}/{kind}' for kind in PATCH_KINDS]:
+        os.makedirs(p, exist_ok=True)
+
+    # Set up logging
+    setup_logging(patch_out_path)
+
+    logger.info(f'Using data from {isplitdata_root}')
+    logger.info(f'Using meta spreadsheet {sheet_path}')
+    logger.info(f'Writing outputs to {patch_out_path}')
+
+    included = []
+    for cgrp in class_groups_to_include:
+        cgrp_classes = utils.CLASS_GROUPS[cgrp]
+        logger.info(f'Including class group {cgrp}, containing classes {cgrp_classes}')
+        included.extend(utils.CLASS_GROUPS[cgrp])
+    DATA_SELECTION = included
+
+    hashes = [source_hash(p, p.with_name(f'{p.stem}_{cfg.label_name}.png')) for p in img_paths]
+    settings_sha1 = settings_hash(cfg)
+    xlsx_export = cfg.patchifyseg.xlsx_export
+    patchmeta_path = utils.resolve_table_path(f'{patch_out_path}/patchmeta.parquet')
+    sources_path = utils.resolve_table_path(f'{patch_out_path}/patchsources.parquet')
+
+    old_patchmeta = None
+    if cfg.patchifyseg.incremental and patchmeta_path.is_file() and sources_path.is_file():
+        old_patchmeta = utils.read_table(patchmeta_path, index_col=0)
+        old_sources = utils.read_table(sources_path)
+        if not (old_sources.settings_sha1 == settings_sha1).all():
+            logger.warning('Patch settings have changed since the existing patch dataset was created. Rebuilding it from scratch.')
+            old_patchmeta = None
+    elif cfg.patchifyseg.incremental:
+        logger.info(f'No existing patch dataset with source manifest found in {patch_out_path}. Building it from scratch.')
+
+    if old_patchmeta is None:
+        per_image_patchmeta = patchify_images(cfg, img_paths, patch_out_path)
+        patchmeta = make_patchmeta_table(per_image_patchmeta)
+        sources = make_sources_table(img_paths, hashes, per_image_patchmeta, first_patch_id=0, settings_sha1=settings_sha1)
+    else:
+        # Append new patches after the highest patch id of the existing dataset, so ids are never reused within a run
+        first_patch_id = int((old_sources.first_patch_id + old_sources.n_patches).max()) if len(old_sources) > 0 else 0
+
+        # Keep sources that still exist with identical content, drop the patches of all others (changed or removed)
+        current = set(zip(map(str, img_paths), hashes))
+        keep = np.array([(p, h) in current for p, h in zip(old_sources.img_path, old_sources.sha1)], dtype=bool)
+        stale = old_sources.loc[~keep]
+        stale_ids = [patch_id for s in stale.itertuples() for patch_id in range(s.first_patch_id, s.first_patch_id + s.n_patches)]
+        remove_patches(patch_out_path, stale_ids)
+        old_patchmeta = old_patchmeta.drop(index=stale_ids)
+        old_sources = old_sources.loc[keep]
+
+        represented = set(zip(old_sources.img_path, old_sources.sha1))
+        new = [i for i, (p, h) in enumerate(zip(map(str, img_paths), hashes)) if (p, h) not in represented]
+        new_img_paths = [img_paths[i] for i in new]
+        logger.info(f'Incremental mode: {len(old_sources)} sources unchanged, {len(stale)} changed or removed, {len(new_img_paths)} new or changed')
+
+        per_image_patchmeta = patchify_images(cfg, new_img_paths, patch_out_path, first_patch_id=first_patch_id)
+        patchmeta = make_patchmeta_table([old_patchmeta, *per_image_patchmeta])
+        new_sources = make_sources_table(new_img_paths, [hashes[i] for i in new], per_image_patchmeta, first_patch_id=first_patch_id, settings_sha1=settings_sha1)
+        sources = pd.concat([old_sources, new_sources], ignore_index=True)
+
+    patchmeta_path = utils.write_table(patchmeta, patchmeta_path, index_label='patch_id', xlsx_export=xlsx_export)
+    utils.write_table(sources, sources_path, xlsx_export=xlsx_export)
+
+    if cfg.patchifyseg.patch_store:
+        convert_png_dataset(patch_out_path, patchmeta_path=patchmeta_path)
+    else:
+        remove_patch_store(patch_out_path)  # Would be out of sync with the PNG files
+
+    write_sampling_tables(patchmeta, patch_out_path, xlsx_export=xlsx_export)
+
+
 if __name__ == '__main__':
     main()
@@ -17,6 +17,7 @@ import torch
 import pandas as pd
 import torch.backends.cudnn
 
+from scipy import ndimage
 from skimage import morphology as sm
 from skimage.color import label2rgb
 from sklearn import metrics as sme
@@ -32,6 +33,7 @@ from elektronn3.data import transforms
 
 from emcaps import utils
 from emcaps.utils import inference_utils as iu
+from emcaps.utils.region_utils import match_instances
 
 torch.backends.cudnn.benchmark = True
 
@@ -80,7 +82,7 @@ def produce_metrics(thresh, results_root, segmenter_path, classifier_path, data_
 - X_fp_error_overlay.jpg: map of false positive predictions w.r.t. GT labels, overlayed on raw image
 - X_cls.jpg: Classifier-based recolorization of segmentation
 - X_overlay_cls.jpg: Classifier-based recolorization of segmentation, overlayed on raw image
-- X_cls_table.xlsx: Classification / region analysis results in tabular form
+- X_cls_table.parquet: Classification / region analysis results in tabular form (also as .xlsx if segment.xlsx_export is set)
 
 Info:
 - data: {data_selection}
@@ -97,6 +99,42 @@ Info:
     return metrics_dict
 
 
+INSTANCE_COUNT_KEYS = ['n_gt', 'n_pred', 'n_matched', 'n_missed', 'n_spurious']
+
+
+def summarize_instance_counts(counts: pd.DataFrame) -> pd.Series:
+    """Sum up per-image particle counts and compute object-level precision, recall and F1 score"""
+    sums = counts[INSTANCE_COUNT_KEYS].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums['precision'] = sums['n_matched'] / sums['n_pred']
+        sums['recall'] = sums['n_matched'] / sums['n_gt']
+        sums['f1'] = 2 * sums['n_matched'] / (sums['n_pred'] + sums['n_gt'])
+    return sums
+
+
+def produce_instance_metrics(instance_counts: list[dict], results_root: Path) -> pd.DataFrame:
+    """Aggregate object-level metrics per Dataset Name and Image Type (and per Enc Type) and write them to tables"""
+    counts = pd.DataFrame(instance_counts)
+    counts.to_excel(results_root / 'instance_counts.xlsx', index=False)
+    rows = {('All', 'All'): summarize_instance_counts(counts)}
+    for dataset_name, dcounts in counts.groupby('Dataset Name'):
+        rows[(dataset_name, 'All')] = summarize_instance_counts(dcounts)
+        for image_type, icounts in dcounts.groupby('Image Type'):
+            rows[(dataset_name, image_type)] = summarize_instance_counts(icounts)
+    table = pd.DataFrame.from_dict(rows, orient='index')
+    table.index.names = ['Dataset Name', 'Image Type']
+    table = table.round(2)
+    table.to_excel(results_root / 'metrics_instances.xlsx')
+    table.to_html(results_root / 'metrics_instances.html')
+
+    per_class = pd.DataFrame({enctype: summarize_instance_counts(ecounts) for enctype, ecounts in counts.groupby('Enc Type')}).T
+    per_class.index.name = 'Enc Type'
+    per_class = per_class.round(2)
+    per_class.to_excel(results_root / 'metrics_instances_per_class.xlsx')
+    per_class.to_html(results_root / 'metrics_instances_per_class.html')
+    return table
+
+
 def is_empty(targets) -> bool:
     # No positive value found in any target -> metrics are undefined, so skip this group
     return len(targets) == 0 or np.concatenate(targets, axis=None).max() == 0
@@ -207,6 +245,8 @@ def main(cfg: DictConfig) -> None:
                 per_group_results[dataset_name][image_type] = {'targets': [], 'preds': [], 'probs': []}
                 # dfdict[dataset_name][image_type] = {}
 
+    instance_counts = []  # Per-image object-level particle counts
+
     # img_paths = random.sample(img_paths, 5)  # Uncomment to test a small sample
     assert len(img_paths) > 0
     for img_path in img_paths:
@@ -302,13 +342,16 @@ def main(cfg: DictConfig) -> None:
                         min_circularity=cfg.segment.min_circularity,
                         return_relabeled_seg=True,
                         allowed_classes=ccc,
+                        classifier_tta=cfg.segment.classifier_tta,
+                        border_mode=cfg.segment.border_mode,
+                        properties=iu.RPROPS_DEFAULT,  # Everything that is needed for the xlsx table
                     )
                     cls_ov = utils.render_skimage_overlay(img=raw_img, lab=cls_relabeled, colors=iu.skimage_color_cycle)
                     iio.imwrite(eu(f'{results_path}/{basename}_overlay_cls{constraint_signature}.jpg'), cls_ov)
                     cls = utils.render_skimage_overlay(img=None, lab=cls_relabeled, colors=iu.skimage_color_cycle)
                     iio.imwrite(eu(f'{results_path}/{basename}_cls{constraint_signature}.png'), cls)
 
-                    iu.save_properties_to_xlsx(properties=rprops, xlsx_out_path=results_path / f'{basename}_cls_table{constraint_signature}.xlsx')
+                    iu.save_properties_table(properties=rprops, out_path=results_path / f'{basename}_cls_table{constraint_signature}.parquet', xlsx_export=cfg.segment.xlsx_export)
 
         if use_database and 'error_maps' in desired_outputs:
             # Create error image
@@ -337,6 +380,19 @@ def main(cfg: DictConfig) -> None:
             iio.imwrite(eu(f'{results_path}/{basename}_fn_error_overlay.jpg'), fn_overlay)
 
 
+        if use_database and 'metrics' in desired_outputs:
+            # Object-level particle detection: match predicted components to GT components
+            pred_cc, n_pred = ndimage.label(cout > 0)
+            gt_cc, n_gt = ndimage.label(lab_img > 0)
+            matches = match_instances(pred_cc, n_pred, gt_cc, n_gt, iou_threshold=cfg.segment.instance_iou_threshold)
+            instance_counts.append({
+                'image': basename,
+                'Dataset Name': dataset_name,
+                'Image Type': image_type,
+                'Enc Type': utils.get_image_entry(img_path, column_name='Enc Type', sheet_path=cfg.sheet_path),
+                **{k: matches[k] for k in INSTANCE_COUNT_KEYS},
+            })
+
         m_target = (lab_img > 0)#.reshape(-1)
         m_pred = (cout > 0)#.reshape(-1))
         m_prob = (out[0, 1])#.reshape(-1))
@@ -432,5 +488,9 @@ def main(cfg: DictConfig) -> None:
             mdf.to_excel(results_root / f'metrics_{mkey}.xlsx')
             mdf.to_html(results_root / f'metrics_{mkey}.html')
 
+        logger.info('Calculating instance-level metrics...')
+        instance_metrics = produce_instance_metrics(instance_counts, results_root=results_root)
+        logger.info(f'Instance-level metrics:\n{instance_metrics}')
+
 if __name__ == '__main__':
     main()
@@ -14,7 +14,7 @@ import torch
 import torch.nn as nn
 import math
 
-__all__ = ['effnetv2_s', 'effnetv2_m', 'effnetv2_l', 'effnetv2_xl']
+__all__ = ['effnetv2_t', 'effnetv2_xs', 'effnetv2_s', 'effnetv2_m', 'effnetv2_l', 'effnetv2_xl', 'build_effnetv2']
 
 
 def _make_divisible(v, divisor, min_value=None):
@@ -123,7 +123,7 @@ class MBConv(nn.Module):
 
 
 class EffNetV2(nn.Module):
-    def __init__(self, cfgs, num_classes=1000, width_mult=1., in_c=1):
+    def __init__(self, cfgs, num_classes=1000, width_mult=1., in_c=1, depth_mult=1., head_channels=1792):
         super(EffNetV2, self).__init__()
         self.cfgs = cfgs
 
@@ -134,12 +134,13 @@ class EffNetV2(nn.Module):
         block = MBConv
         for t, c, n, s, use_se in self.cfgs:
             output_channel = _make_divisible(c * width_mult, 8)
+            n = int(math.ceil(n * depth_mult))
             for i in range(n):
                 layers.append(block(input_channel, output_channel, s if i == 0 else 1, t, use_se))
                 input_channel = output_channel
         self.features = nn.Sequential(*layers)
         # building last several layers
-        output_channel = _make_divisible(1792 * width_mult, 8) if width_mult > 1.0 else 1792
+        output_channel = _make_divisible(head_channels * width_mult, 8) if width_mult > 1.0 else head_channels
         self.conv = conv_1x1_bn(input_channel, output_channel)
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         self.classifier = nn.Linear(output_channel, num_classes)
@@ -169,6 +170,42 @@ class EffNetV2(nn.Module):
                 m.bias.data.zero_()
 
 
+# The following two variants are not part of the original EfficientNetV2 family.
+# They are meant for small (49x49) single-channel patches, where the large
+# models are needlessly slow: Fewer and shallower stages and a narrower head.
+
+def effnetv2_t(**kwargs):
+    """
+    Constructs a tiny EfficientNetV2 model for small patches
+    """
+    cfgs = [
+        # t, c, n, s, SE
+        [1,  16,  1, 1, 0],
+        [4,  32,  2, 2, 0],
+        [4,  48,  2, 2, 0],
+        [4,  96,  2, 2, 1],
+        [6, 128,  2, 1, 1],
+    ]
+    kwargs.setdefault('head_channels', 512)
+    return EffNetV2(cfgs, **kwargs)
+
+
+def effnetv2_xs(**kwargs):
+    """
+    Constructs an extra small EfficientNetV2 model for small patches
+    """
+    cfgs = [
+        # t, c, n, s, SE
+        [1,  24,  2, 1, 0],
+        [4,  48,  2, 2, 0],
+        [4,  64,  3, 2, 0],
+        [4, 128,  3, 2, 1],
+        [6, 160,  4, 1, 1],
+    ]
+    kwargs.setdefault('head_channels', 1024)
+    return EffNetV2(cfgs, **kwargs)
+
+
 def effnetv2_s(**kwargs):
     """
     Constructs a EfficientNetV2-S model
@@ -234,3 +271,23 @@ def effnetv2_xl(**kwargs):
         [6, 640,  8, 1, 1],
     ]
     return EffNetV2(cfgs, **kwargs)
+
+
+_variants = {
+    'effnetv2_t': effnetv2_t,
+    'effnetv2_xs': effnetv2_xs,
+    'effnetv2_s': effnetv2_s,
+    'effnetv2_m': effnetv2_m,
+    'effnetv2_l': effnetv2_l,
+    'effnetv2_xl': effnetv2_xl,
+}
+
+
+def build_effnetv2(name, **kwargs):
+    """
+    Constructs an EfficientNetV2 variant by name, e.g. build_effnetv2('effnetv2_s', in_c=1, num_classes=8).
+    width_mult and depth_mult kwargs can be used to further scale the channels and the number of blocks per stage
+    """
+    if name not in _variants:
+        raise ValueError(f'Unknown model {name}. Valid choices are {list(_variants.keys())}')
+    return _variants[name](**kwargs)
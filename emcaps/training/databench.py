@@ -0,0 +1,135 @@
+"""
+Device selection and throughput benchmarking of training data pipelines.
+
+benchmark_data() iterates a training dataset with a DataLoader that is set up like the one
+of the elektronn3 Trainer (same batch size, num_workers and collate function) and reports
+samples/sec, time spent in each transform and data loader worker utilisation.
+No model is involved, so loader bottlenecks can be found on hosts without a GPU.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+
+import torch
+from torch.utils import data
+
+
+logger = logging.getLogger('emcaps-databench')
+
+
+def get_device(name: Optional[str] = 'auto') -> torch.device:
+    """Get the torch device to train on. 'auto' (or None) selects cuda if it is available.
+    Falls back to cpu with a warning if a cuda device is requested but not available."""
+    if name is None or name == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        logger.warning(f'Device {name} was requested, but CUDA is not available. Falling back to cpu.')
+        return torch.device('cpu')
+    return device
+
+
+class TimedCompose:
+    """Replacement for transforms.Compose that accumulates the time spent in each transform.
+
+    Times are collected per process (i.e. per data loader worker) and returned by pop_times()."""
+    def __init__(self, transforms):
+        self.transforms = transforms
+        # Unique names, because the same transform type can occur more than once
+        self.names = [f'{i}_{type(t).__name__}' for i, t in enumerate(transforms)]
+        self.times = defaultdict(float)
+
+    def __call__(self, inp, target=None):
+        for name, t in zip(self.names, self.transforms):
+            t0 = time.perf_counter()
+            inp, target = t(inp, target)
+            self.times[name] += time.perf_counter() - t0
+        return inp, target
+
+    def pop_times(self) -> Dict[str, float]:
+        times = {name: self.times[name] for name in self.names}
+        self.times = defaultdict(float)
+        return times
+
+
+class _TimedDataset(data.Dataset):
+    """Wraps a dataset whose transform is a TimedCompose and adds timings to each sample"""
+    def __init__(self, dataset: data.Dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        t0 = time.perf_counter()
+        sample = self.dataset[index]
+        sample['load_time'] = time.perf_counter() - t0
+        sample['transform_times'] = self.dataset.transform.pop_times()
+        return sample
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class _TimedCollate:
+    def __init__(self, collate_fn: Callable):
+        self.collate_fn = collate_fn
+
+    def __call__(self, samples):
+        t0 = time.perf_counter()
+        batch = self.collate_fn(samples)
+        batch['collate_time'] = time.perf_counter() - t0
+        return batch
+
+
+def benchmark_data(
+        dataset: data.Dataset,
+        batch_size: int,
+        num_workers: int,
+        num_batches: int = 100,
+        collate_fn: Callable = data.default_collate,
+        device: torch.device = torch.device('cpu'),
+) -> Dict[str, float]:
+    """Measure the throughput of a training dataset (with its configured transform) in a DataLoader.
+
+    The first batch is excluded from throughput measurement because it includes worker startup.
+    Worker utilisation is the fraction of wall time that the workers (or the main process if
+    num_workers=0) spent loading samples and collating batches."""
+    transform = dataset.transform
+    dataset.transform = TimedCompose(getattr(transform, 'transforms', [transform]))
+    loader = data.DataLoader(
+        _TimedDataset(dataset), batch_size=batch_size, shuffle=True, num_workers=num_workers,
+        pin_memory=device.type == 'cuda', collate_fn=_TimedCollate(collate_fn),
+    )
+    n_samples = 0
+    busy_time = 0.
+    transform_times = defaultdict(float)
+    try:
+        batches = iter(loader)
+        next(batches)  # Warmup
+        t0 = time.perf_counter()
+        for _ in range(num_batches):
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            batch['inp'].to(device, non_blocking=True)
+            n_samples += batch['inp'].shape[0]
+            busy_time += batch['load_time'].sum().item() + batch['collate_time']
+            for name, times in batch['transform_times'].items():
+                transform_times[name] += times.sum().item()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        wall_time = time.perf_counter() - t0
+    finally:
+        dataset.transform = transform
+
+    results = {
+        'samples_per_sec': n_samples / wall_time,
+        'worker_ms_per_sample': busy_time / n_samples * 1000,
+        'worker_utilisation': busy_time / (wall_time * max(num_workers, 1)),
+    }
+    for name, total in transform_times.items():
+        results[f'transform_ms_per_sample/{name}'] = total / n_samples * 1000
+    lines = '\n'.join(f'  {k}: {v:.3f}' for k, v in results.items())
+    logger.info(f'Data pipeline benchmark ({n_samples} samples, num_workers={num_workers}, device={device}):\n{lines}')
+    return results
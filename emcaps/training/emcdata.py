@@ -4,9 +4,11 @@ PyTorch Dataset classes for loading encapsulin segmentation and classification d
 
 # TODO: Rename module
 
+import hashlib
 import logging
 import hydra
 import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Sequence, Tuple, Union, Callable
@@ -20,6 +22,7 @@ from skimage import morphology as sm
 from torch.utils import data
 
 from emcaps import utils
+from emcaps.utils.patch_store import load_patches, open_patch_store, store_patches
 
 logger = logging.getLogger('emcaps-emcdata')
 
@@ -30,6 +33,74 @@ def mimread(*args, **kwargs):
     return iio.imread(*args, **kwargs)
 
 
+class ImageCache:
+    """Memory-mapped cache of decoded images, shared between data loader workers.
+
+    All images are decoded once (in num_threads parallel threads) and appended to one flat
+    cache file in cache_dir, with an index of byte offsets, shapes and dtypes. Workers read images as
+    zero-copy views of the memory map, so decoded pixels are kept only once (in the OS page cache)
+    instead of once per worker. The cache file name is derived from the paths, sizes and
+    modification times of the images, so changed images lead to a new cache."""
+    _FORMAT_VERSION = 2  # Part of the cache key, so caches with an outdated index layout are not reused
+    _ALIGNMENT = 8  # Byte alignment of each image in the cache file
+
+    def __init__(self, paths: Sequence[Path], cache_dir: Path | str, num_threads: int = 8):
+        self.paths = [Path(p) for p in paths]
+        self.positions = {str(p): i for i, p in enumerate(self.paths)}
+        stats = [(str(p), p.stat().st_size, p.stat().st_mtime_ns) for p in self.paths]
+        key = hashlib.sha1(repr((self._FORMAT_VERSION, stats)).encode()).hexdigest()[:16]
+        cache_dir = Path(cache_dir).expanduser()
+        self.data_path = cache_dir / f'imagecache_{key}.bin'
+        self.index_path = cache_dir / f'imagecache_{key}.npz'
+        if not (self.data_path.is_file() and self.index_path.is_file()):
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._build(num_threads)
+        index = np.load(self.index_path)
+        self.offsets = index['offsets']
+        self.shapes = [tuple(shape[:ndim]) for shape, ndim in zip(index['shapes'], index['ndims'])]
+        self.dtypes = [np.dtype(dtype) for dtype in index['dtypes']]
+        self._data = None  # Opened lazily, so each worker process maps the file itself
+
+    def _build(self, num_threads: int) -> None:
+        logger.info(f'Decoding {len(self.paths)} images to cache file {self.data_path}')
+        offsets = np.zeros((len(self.paths),), dtype=np.int64)
+        shapes = np.zeros((len(self.paths), 3), dtype=np.int64)
+        ndims = np.zeros((len(self.paths),), dtype=np.int64)
+        dtypes = []
+        tmp_path = self.data_path.with_suffix('.tmp')
+        offset = 0
+        with open(tmp_path, 'wb') as f, ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for i, img in enumerate(executor.map(iio.imread, self.paths)):
+                padding = -offset % self._ALIGNMENT
+                f.write(bytes(padding))
+                offset += padding
+                f.write(np.ascontiguousarray(img).tobytes())
+                offsets[i] = offset
+                shapes[i, :img.ndim] = img.shape
+                ndims[i] = img.ndim
+                dtypes.append(img.dtype.str)
+                offset += img.nbytes
+        np.savez(self.index_path, offsets=offsets, shapes=shapes, ndims=ndims, dtypes=np.array(dtypes, dtype=str))
+        tmp_path.replace(self.data_path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None  # Don't pickle mapped data
+        return state
+
+    def __contains__(self, path: Path | str) -> bool:
+        return str(path) in self.positions
+
+    def __getitem__(self, path: Path | str) -> np.ndarray:
+        """Read-only view of a decoded image"""
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        i = self.positions[str(path)]
+        shape, dtype = self.shapes[i], self.dtypes[i]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._data[self.offsets[i]:self.offsets[i] + nbytes].view(dtype).reshape(shape)
+
+
 # Credit: https://newbedev.com/how-can-i-create-a-circular-mask-for-a-numpy-array
 def create_circular_mask(h, w, center=None, radius=None):
     if center is None:  # use the middle of the image
@@ -42,8 +113,114 @@ def create_circular_mask(h, w, center=None, radius=None):
     return mask
 
 
+class ToDtype:
+    """Transform that casts inputs to dtype, e.g. to convert cropped uint8 images to float before normalization"""
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+
+    def __call__(self, inp, target=None):
+        return inp.astype(self.dtype), target
+
+
+class NormalizingCollate:
+    """Collate samples to a batch and normalize batch['inp'] channel-wise (same as transforms.Normalize, but for whole batches).
+
+    Used as collate_fn of data loaders, so datasets can keep their uint8 data resident
+    and don't need to normalize each sample separately."""
+    def __init__(self, mean: Sequence[float], std: Sequence[float], dtype: torch.dtype = torch.float32):
+        self.mean = torch.as_tensor(mean, dtype=dtype)[:, None, None]  # (C, 1, 1)
+        self.std = torch.as_tensor(std, dtype=dtype)[:, None, None]
+        self.dtype = dtype
+
+    def __call__(self, samples):
+        batch = data.default_collate(samples)
+        batch['inp'] = (batch['inp'].to(self.dtype) - self.mean) / self.std
+        return batch
+
+
+class BatchAugmentingCollate(NormalizingCollate):
+    """NormalizingCollate that additionally augments whole (B, C, H, W) input batches with vectorized torch ops.
+
+    Replaces per-sample transforms.RandomFlip and AlbuSeg2d(albumentations.ShiftScaleRotate) with the same
+    parameter distributions: Each spatial axis is flipped with probability 0.5 (if flip), then with probability
+    affine_prob, a random rotation (uniform in [-rotate_limit, rotate_limit] degrees), scaling (by a factor
+    uniform in [1 - scale_limit, 1 + scale_limit]) and shift (uniform in [-shift_limit, shift_limit] times
+    the image size) around the image center are applied with bicubic interpolation and reflection padding.
+    Targets are not augmented, so this is only meant for image-level classification."""
+    def __init__(
+            self,
+            mean: Sequence[float],
+            std: Sequence[float],
+            dtype: torch.dtype = torch.float32,
+            flip: bool = True,
+            affine_prob: float = 0.,
+            rotate_limit: float = 180.,
+            scale_limit: float = 0.02,
+            shift_limit: float = 0.,
+    ):
+        super().__init__(mean=mean, std=std, dtype=dtype)
+        self.flip = flip
+        self.affine_prob = affine_prob
+        self.rotate_limit = rotate_limit
+        self.scale_limit = scale_limit
+        self.shift_limit = shift_limit
+
+    def augment(self, inp: torch.Tensor) -> torch.Tensor:
+        """Randomly flip and warp each image of a (B, C, H, W) float batch"""
+        b = inp.shape[0]
+        if self.flip:
+            for dim in (-2, -1):
+                flipped = torch.rand(b) < 0.5
+                inp = torch.where(flipped[:, None, None, None], inp.flip(dim), inp)
+        if self.affine_prob > 0:
+            warped = torch.rand(b) < self.affine_prob
+            if torch.any(warped):
+                inp = inp.clone()
+                inp[warped] = self._warp(inp[warped])
+        return inp
+
+    def _warp(self, inp: torch.Tensor) -> torch.Tensor:
+        b, _, h, w = inp.shape
+        angle = torch.deg2rad((torch.rand(b) * 2 - 1) * self.rotate_limit)
+        scale = 1 + (torch.rand(b) * 2 - 1) * self.scale_limit
+        shift = (torch.rand(b, 2) * 2 - 1) * self.shift_limit * 2  # In normalized [-1, 1] coordinates (x, y)
+        # affine_grid maps output to input coordinates, so theta is the inverse transformation.
+        # Rotation is performed in pixel space, so normalized coordinates are rescaled by the aspect ratio.
+        cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+        aspect = w / h
+        m = torch.stack([
+            torch.stack([cos, sin / aspect], dim=1),
+            torch.stack([-sin * aspect, cos], dim=1),
+        ], dim=1)  # (B, 2, 2)
+        offset = -(m @ shift[:, :, None])  # (B, 2, 1)
+        theta = torch.cat([m, offset], dim=2)  # (B, 2, 3)
+        grid = torch.nn.functional.affine_grid(theta.to(inp.dtype), list(inp.shape), align_corners=False)
+        return torch.nn.functional.grid_sample(inp, grid, mode='bicubic', padding_mode='reflection', align_corners=False)
+
+    def __call__(self, samples):
+        batch = data.default_collate(samples)
+        inp = self.augment(batch['inp'].to(self.dtype))
+        batch['inp'] = (inp - self.mean) / self.std
+        return batch
+
+
+def set_collate_fn(loaders: Sequence[Optional[data.DataLoader]], collate_fn: Callable) -> None:
+    """Replace the collate_fn of already constructed data loaders (e.g. the ones created by elektronn3's Trainer)"""
+    for loader in loaders:
+        if loader is not None:
+            loader.collate_fn = collate_fn
+
+
 class EncPatchData(data.Dataset):
-    """Image-level classification dataset loader for small patches, similar to MNIST"""
+    """Image-level classification dataset loader for small patches, similar to MNIST
+
+    Patches are kept in memory as uint8 and only converted to inp_dtype per sample, without normalization.
+    Use NormalizingCollate to normalize them per batch.
+    If the patch dataset has a patch store (see emcaps/utils/patch_store.py), its stacks are memory-mapped,
+    so nothing needs to be decoded at startup and pages are shared between data loader workers.
+    Else, PNG files are decoded in num_decode_threads parallel threads. With persist_patch_store,
+    the decoded patches of the whole sheet are then written to a patch store for the next runs
+    (an existing patch store is only extended by the missing kinds, see store_patches())."""
     def __init__(
             self,
             # data_root: str,
@@ -56,6 +233,8 @@ class EncPatchData(data.Dataset):
             erase_mask_bg: bool = False,
             erase_disk_mask_radius: int = 0,
             epoch_multiplier: int = 1,  # Pretend to have more data in one epoch
+            num_decode_threads: int = 8,
+            persist_patch_store: bool = False,
     ):
         super().__init__()
         # self.data_root = data_root
@@ -68,7 +247,7 @@ class EncPatchData(data.Dataset):
         self.erase_disk_mask_radius = erase_disk_mask_radius
         self.epoch_multiplier = epoch_multiplier
 
-        sheet = pd.read_excel(descr_sheet[0], sheet_name=descr_sheet[1])
+        sheet = utils.read_table(descr_sheet[0]) if descr_sheet[1] == 0 else pd.read_excel(descr_sheet[0], sheet_name=descr_sheet[1])
         self._sheet = sheet
         meta = sheet.copy()
 
@@ -84,48 +263,55 @@ class EncPatchData(data.Dataset):
         # self.root_path = Path(data_root).expanduser()
         self.root_path = Path(descr_sheet[0]).parent
 
-        self.inps = []
-        self.targets = []
-
-        for patch_meta in self.meta.itertuples():
-            inp = mimread(self.root_path / 'raw' / patch_meta.patch_fname).copy()
-            # cmax = mimread(self.root_path / 'cmax' / patch_meta.patch_fname.replace('raw', 'cmax')).copy()
-            # cavg = mimread(self.root_path / 'cavg' / patch_meta.patch_fname.replace('raw', 'cavg')).copy()
-
-            if self.erase_mask_bg:
-                # Erase mask background from inputs
-                mask = mimread(self.root_path / 'mask' / patch_meta.patch_fname.replace('raw', 'mask')).copy()
-                if self.dilate_masks_by > 0:
-                    disk = sm.disk(self.dilate_masks_by)
-                    # mask_patch = ndimage.binary_dilation(mask_patch, iterations=DILATE_MASKS_BY)
-                    mask = sm.binary_dilation(mask, footprint=disk)
-                inp[mask == 0] = 0
-            if self.erase_disk_mask_radius > 0:
-                mask = create_circular_mask(*inp.shape, radius=self.erase_disk_mask_radius)
-                inp[mask > 0] = 0
-
-            # mask = mimread(self.root_path / 'mask' / patch_meta.patch_fname.replace('raw', 'mask'))
-            # inp = mask * 255
-
-            # inp = np.stack((inp, cmax, cavg), axis=0)
-
-            target = utils.CLASS_IDS[patch_meta.enctype]
-            self.inps.append(inp)
-            self.targets.append(target)
-
-        self.inps = np.stack(self.inps).astype(self.inp_dtype)
-        self.targets = np.stack(self.targets).astype(self.target_dtype)
+        kinds = ['raw', 'mask'] if self.erase_mask_bg else ['raw']
+        fnames = list(self.meta.patch_fname)
+        store = open_patch_store(self.root_path, kinds=kinds, fnames=fnames)
+        if store is None and persist_patch_store:
+            logger.info(f'Writing patch store for {self._sheet.shape[0]} patches to {self.root_path}')
+            store = store_patches(self.root_path, self._sheet.patch_fname, kinds=kinds, num_threads=num_decode_threads)
+        if store is not None:
+            # (N, H, W) uint8 memmaps, indexed by patch id
+            self.inp_ids = store.ids(fnames)
+            self.inps = store.stack('raw')
+            self.masks = store.stack('mask') if self.erase_mask_bg else None
+        else:
+            # (N, H, W) uint8 arrays, indexed by row
+            self.inp_ids = np.arange(len(fnames))
+            self.inps = load_patches(self.root_path, 'raw', fnames, num_threads=num_decode_threads)
+            self.masks = load_patches(self.root_path, 'mask', fnames, num_threads=num_decode_threads) if self.erase_mask_bg else None
+        self.targets = np.array([utils.CLASS_IDS[enctype] for enctype in self.meta.enctype], dtype=self.target_dtype)
+        # Sample names, precomputed so __getitem__ doesn't need to touch self.meta
+        self.fnames = np.array([f'{fname} ({target})' for fname, target in zip(fnames, self.targets)])
+
+        self._dilation_disk = sm.disk(self.dilate_masks_by) if self.dilate_masks_by > 0 else None
+        self._erase_disk_mask = None
+        if self.erase_disk_mask_radius > 0:
+            self._erase_disk_mask = create_circular_mask(*self.inps.shape[1:], radius=self.erase_disk_mask_radius)
 
         for enctype in meta.enctype.unique():
             logger.info(f'{enctype}: {meta[meta.enctype == enctype].shape[0]}')
 
+    def get_inp(self, index: int) -> np.ndarray:
+        """Get input patch (as inp_dtype) with mask or disk background erasing applied"""
+        inp = self.inps[self.inp_ids[index]].astype(self.inp_dtype)
+        # cmax = mimread(self.root_path / 'cmax' / patch_meta.patch_fname.replace('raw', 'cmax')).copy()
+        # cavg = mimread(self.root_path / 'cavg' / patch_meta.patch_fname.replace('raw', 'cavg')).copy()
+        if self.erase_mask_bg:
+            # Erase mask background from inputs
+            mask = self.masks[self.inp_ids[index]]
+            if self._dilation_disk is not None:
+                # mask_patch = ndimage.binary_dilation(mask_patch, iterations=DILATE_MASKS_BY)
+                mask = sm.binary_dilation(mask, footprint=self._dilation_disk)
+            inp[mask == 0] = 0
+        if self._erase_disk_mask is not None:
+            inp[self._erase_disk_mask] = 0
+        return inp
+
     def __getitem__(self, index):
         index %= len(self.meta)  # Wrap around to support epoch_multiplier
-        inp = self.inps[index]
+        inp = self.get_inp(index)
         target = self.targets[index]
-        fname = self.meta.patch_fname.iloc[index]
-        label_name = target
-        fname = f'{fname} ({label_name})'
+        fname = self.fnames[index]
         if inp.ndim == 2:
             inp = inp[None]  # (C=1, H, W)
         # Pass None instead of target because scalar targets are not to be augmented.
@@ -145,7 +331,17 @@ class EncSegData(data.Dataset):
     """Using a special TIF file directory structure for segmentation data loading.
 
     Version for segtrain.py and dataset v6+.
-    For training on all conditions or a subset thereof."""
+    For training on all conditions or a subset thereof.
+
+    Images are passed to the transform as uint8 and labels are kept as bool masks, so full images are
+    never converted to float. The transform is expected to crop before converting the input (see ToDtype).
+
+    If crop_shape is set, samples are cropped by the dataset itself, before targets are computed (so
+    RandomCrop is not needed in transform). With probability crop_fg_prob, the crop is drawn from the
+    crop origins (on a grid of crop_origin_stride pixels) whose foreground ratio is at least crop_fg_threshold.
+    These are found once at construction with an integral image of each foreground label.
+    Otherwise (or if an image has no such crop), the crop origin is drawn uniformly, like RandomCrop does.
+    Samples are never rejected and resampled, so transforms must not raise transforms._DropSample."""
     def __init__(
             self,
             # data_root: str,
@@ -166,6 +362,12 @@ class EncSegData(data.Dataset):
             enable_partial_inversion_hack: bool = False,
             dilate_targets_by: int = 0,
             epoch_multiplier=1,  # Pretend to have more data in one epoch
+            image_cache_dir: Optional[str] = None,  # If set, decode all images once into an ImageCache there
+            num_decode_threads: int = 8,
+            crop_shape: Optional[Sequence[int]] = None,
+            crop_fg_threshold: float = 0.05,
+            crop_fg_prob: float = 0.,
+            crop_origin_stride: int = 4,
     ):
         super().__init__()
         # self.data_root = data_root
@@ -184,6 +386,10 @@ class EncSegData(data.Dataset):
         self.enable_binary_seg = enable_binary_seg
         self.enable_partial_inversion_hack = enable_partial_inversion_hack
         self.dilate_targets_by = dilate_targets_by
+        self.crop_shape = None if crop_shape is None else tuple(crop_shape)
+        self.crop_fg_threshold = crop_fg_threshold
+        self.crop_fg_prob = crop_fg_prob
+        self.crop_origin_stride = crop_origin_stride
 
         if self.ignore_far_background_distance:
             self.ifbd_disk = sm.disk(self.ignore_far_background_distance)
@@ -216,41 +422,118 @@ class EncSegData(data.Dataset):
 
         self.meta = meta
 
+        # Per-image metadata as arrays, so __getitem__ doesn't need to touch self.meta or the file system
+        self.img_nums = np.array(self.meta.num.to_list())
+        img_nums = self.img_nums
+        sconds = self.meta.scond.to_numpy(dtype=object)
+        self.inp_paths = []
+        self.label_paths = []
+        for img_num in img_nums:
+            inp_path, label_paths = self._get_paths(img_num)
+            self.inp_paths.append(inp_path)
+            self.label_paths.append(label_paths)
+        # (N, len(label_names)) bool array of label files that exist
+        self.label_available = np.array(
+            [[path.exists() for path in label_paths] for label_paths in self.label_paths], dtype=bool
+        ).reshape(len(img_nums), len(self.label_names))
+        # Labels are inverted if exactly one of invert_labels and the partial inversion hack applies
+        # TODO: Investigate why labels are inverted although images look fine (partial inversion hack)
+        self.invert_label_flags = np.array(
+            [self.invert_labels != (self.enable_partial_inversion_hack and int(num) < 55) for num in img_nums], dtype=bool
+        )
+        self.ignore_far_background_flags = self.meta.scond.eq('HEK-1xTmEnc-BC2-Tag').fillna(False).to_numpy(dtype=bool)
+        self.fnames = np.array([f'{num} ({scond})' for num, scond in zip(img_nums, sconds)])
+
+        self.image_cache = None
+        if image_cache_dir is not None:
+            paths = []
+            for inp_path, label_paths, available in zip(self.inp_paths, self.label_paths, self.label_available):
+                paths.append(inp_path)
+                paths.extend(path for path, avail in zip(label_paths, available) if avail)
+            self.image_cache = ImageCache(paths, cache_dir=image_cache_dir, num_threads=num_decode_threads)
+
+        # Check full foreground labels once and find (K, 2) foreground-rich crop origins of each image
+        self.fg_crop_origins = [np.zeros((0, 2), dtype=np.int64) for _ in img_nums]
+        find_fg_crops = self.crop_shape is not None and self.crop_fg_prob > 0
+        for i in np.flatnonzero(self.label_available[:, 1]):
+            fg = self._imread(self.label_paths[i][1]) != 0
+            if self.invert_label_flags[i]:
+                fg = ~fg
+            if fg.mean() > 0.4:
+                logger.warning(f'Unusually high target mean in image number {img_nums[i]}')
+            if find_fg_crops:
+                self.fg_crop_origins[i] = self._find_fg_crop_origins(fg)
+        if find_fg_crops:
+            n_fg_crops = sum(len(o) for o in self.fg_crop_origins)
+            logger.info(f'Found {n_fg_crops} crop origins with foreground ratio >= {self.crop_fg_threshold}')
+
         conditions = self.meta['scond'].unique()
         for condition in conditions:
             _nums = meta.loc[meta['scond'] == condition]['num'].to_list()
             logger.info(f'{condition}:\t({len(_nums)} images):\n {_nums}')
 
-    def __getitem__(self, index):
-        index %= len(self.meta)  # Wrap around to support epoch_multiplier
-        # subdir_path = self.subdir_paths[index]
-        mrow = self.meta.iloc[index]
-        img_num = mrow['num']
+    def _get_paths(self, img_num) -> Tuple[Path, list[Path]]:
+        """Input image path and label paths (one per label name) of an image number"""
         subdir_path = self.root_path / f'{img_num}'
-
-        if self.train:
-            inp_path = subdir_path / f'{img_num}_trn.png'
+        split = 'trn' if self.train else 'val'
+        inp_path = subdir_path / f'{img_num}_{split}.png'
+        label_paths = [subdir_path / f'{img_num}_{split}_{label_name}.png' for label_name in self.label_names]
+        return inp_path, label_paths
+
+    def _find_fg_crop_origins(self, fg: np.ndarray) -> np.ndarray:
+        """Find crop origins (on the stride grid) with foreground ratio >= crop_fg_threshold, using an integral image"""
+        ch, cw = self.crop_shape
+        integral = np.zeros((fg.shape[0] + 1, fg.shape[1] + 1), dtype=np.int64)
+        np.cumsum(np.cumsum(fg, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:])
+        ys = np.arange(0, fg.shape[0] - ch + 1, self.crop_origin_stride)[:, None]
+        xs = np.arange(0, fg.shape[1] - cw + 1, self.crop_origin_stride)[None, :]
+        fg_counts = integral[ys + ch, xs + cw] - integral[ys, xs + cw] - integral[ys + ch, xs] + integral[ys, xs]
+        iy, ix = np.nonzero(fg_counts >= self.crop_fg_threshold * ch * cw)
+        return np.stack([ys[iy, 0], xs[0, ix]], axis=1)
+
+    def _sample_crop(self, index: int, img_shape: Sequence[int]) -> Tuple[Tuple[slice, slice], Tuple[slice, slice]]:
+        """Sample a crop of an image. Returns the crop window (enlarged by a margin for target dilation, if possible)
+        and the slices that select the actual crop from the window"""
+        if any(c > s for c, s in zip(self.crop_shape, img_shape)):
+            raise ValueError(f'crop shape {self.crop_shape} can\'t be larger than image shape {tuple(img_shape)}.')
+        fg_origins = self.fg_crop_origins[index]
+        if len(fg_origins) > 0 and np.random.rand() < self.crop_fg_prob:
+            origin = fg_origins[np.random.randint(len(fg_origins))]
         else:
-            inp_path = subdir_path / f'{img_num}_val.png'
+            origin = [np.random.randint(0, s - c + 1) for c, s in zip(self.crop_shape, img_shape)]
+        # Target dilation and far background marking depend on the surroundings of the crop
+        margin = max(self.dilate_targets_by, 0) + max(self.ignore_far_background_distance, 0)
+        window, inner = [], []
+        for o, c, s in zip(origin, self.crop_shape, img_shape):
+            lo, hi = max(o - margin, 0), min(o + c + margin, s)
+            window.append(slice(lo, hi))
+            inner.append(slice(o - lo, o - lo + c))
+        return tuple(window), tuple(inner)
+
+    def _imread(self, path: Path) -> np.ndarray:
+        """Read a (shared, read-only) decoded image from the image cache if available, else from disk"""
+        if self.image_cache is not None:
+            return self.image_cache[path]
+        return mimread(path)
 
-        inp = mimread(inp_path).astype(self.inp_dtype)
+    def __getitem__(self, index):
+        index %= len(self.meta)  # Wrap around to support epoch_multiplier
+        inp = self._imread(self.inp_paths[index])  # uint8, converted to inp_dtype after transforms
         if inp.ndim == 2:  # (H, W)
             inp = inp[None]  # (C=1, H, W)
+        window = inner = (slice(None), slice(None))
+        if self.crop_shape is not None:
+            window, inner = self._sample_crop(index, inp.shape[1:])
+            inp = inp[(slice(None), *window)]
 
         labels = []
-        for label_name in self.label_names:
-            if self.train:
-                label_path = subdir_path / f'{img_num}_trn_{label_name}.png'
-            else:
-                label_path = subdir_path / f'{img_num}_val_{label_name}.png'
-            if label_path.exists():
-                label = mimread(label_path).astype(np.int64)
-                if self.invert_labels:
-                    label = (label == 0).astype(np.int64)
-                if self.enable_partial_inversion_hack and int(img_num) < 55:  # TODO: Investigate why labels are inverted although images look fine
-                    label = (label == 0).astype(np.int64)
+        for label_path, available in zip(self.label_paths[index], self.label_available[index]):
+            if available:
+                label = self._imread(label_path)[window] != 0
+                if self.invert_label_flags[index]:
+                    label = ~label
             else:  # If label is missing, make it a full zero array
-                label = np.zeros_like(inp[0], dtype=np.int64)
+                label = np.zeros(inp.shape[1:], dtype=bool)
             labels.append(label)
         assert len(labels) > 0
 
@@ -260,40 +543,36 @@ class EncSegData(data.Dataset):
         #     # Assign label index c to target at all locations where the c-th label is non-zero
         #     target[labels[c] != 0] = c
 
-        target[labels[1] != 0] = 1
+        target[labels[1]] = 1
 
         if self.enable_binary_seg:  # Don't distinguish between foreground classes, just use one foreground class
             target[target > 0] = 1
 
         if self.enable_inputmask:  # Zero out input where target == 0 to make background invisible
+            inp = inp.copy()  # Don't modify the memoized or cached image
             for c in range(inp.shape[0]):
                 inp[c][target == 0] = 0
 
-        if target.mean().item() > 0.4:
-            print('Unusually high target mean in image number', img_num)
-
         if self.dilate_targets_by > 0:
             target = sm.binary_dilation(target, footprint=self.td_disk).astype(target.dtype)
 
         # Mark regions to be ignored
-        if self.ignore_far_background_distance > 0 and mrow['scond'] == 'HEK-1xTmEnc-BC2-Tag':
+        if self.ignore_far_background_distance > 0 and self.ignore_far_background_flags[index]:
             dilated_foreground = sm.binary_dilation(target, footprint=self.ifbd_disk)
             far_background = ~dilated_foreground
             target[far_background] = -1
 
-        while True:  # Only makes sense if RandomCrop is used
-            try:
-                inp, target = self.transform(inp, target)
-                break
-            except transforms._DropSample:
-                pass
+        if self.crop_shape is not None:  # Remove crop margin
+            inp, target = inp[(slice(None), *inner)], target[inner]
+
+        inp, target = self.transform(inp, target)
         if np.any(self.offset):
             off = self.offset
             target = target[off[0]:-off[0], off[1]:-off[1]]
         sample = {
             'inp': torch.as_tensor(inp.astype(self.inp_dtype)),
             'target': torch.as_tensor(target.astype(self.target_dtype)),
-            'fname': f'{subdir_path.name} ({mrow["scond"]})',
+            'fname': self.fnames[index],
         }
         return sample
 
@@ -30,8 +30,9 @@ from elektronn3.data import transforms
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 import albumentations
 
-from emcaps.training.emcdata import EncPatchData
-from emcaps.models.effnetv2 import effnetv2_m
+from emcaps.training.databench import benchmark_data, get_device
+from emcaps.training.emcdata import BatchAugmentingCollate, EncPatchData, NormalizingCollate, set_collate_fn
+from emcaps.models.effnetv2 import build_effnetv2
 from emcaps import utils
 
 
@@ -44,7 +45,7 @@ def main(cfg: DictConfig) -> None:
     random.seed(random_seed)
 
     torch.backends.cudnn.benchmark = True  # Improves overall performance in *most* cases
-    device = torch.device('cuda')
+    device = get_device(cfg.patchtrain.device)
     print(f'Running on device: {device}')
 
     ERASE_DISK_MASK_RADIUS = 0
@@ -60,9 +61,14 @@ def main(cfg: DictConfig) -> None:
     in_channels = 1
     out_channels = 8
 
-    # model = effnetv2_s(in_c=1, num_classes=out_channels).to(device)
-    model = effnetv2_m(in_c=in_channels, num_classes=out_channels).to(device)
-    # model = effnetv2_l(in_c=1, num_classes=out_channels).to(device)
+    model_name = cfg.patchtrain.model
+    model = build_effnetv2(
+        model_name,
+        in_c=in_channels,
+        num_classes=out_channels,
+        width_mult=cfg.patchtrain.width_mult,
+        depth_mult=cfg.patchtrain.depth_mult,
+    ).to(device)
 
 
     # USER PATHS
@@ -74,9 +80,11 @@ def main(cfg: DictConfig) -> None:
     lr_dec = cfg.patchtrain.lr_dec
     batch_size = cfg.patchtrain.batch_size
 
-    # Transformations to be applied to samples before feeding them to the network
+    # Transformations to be applied to samples before feeding them to the network.
+    # Normalization is not part of them, it is applied per batch by batch_collate (see below).
+    normalize = transforms.Normalize(mean=cfg.dataset_mean, std=cfg.dataset_std, inplace=False)
+    batch_collate = NormalizingCollate(mean=cfg.dataset_mean, std=cfg.dataset_std)
     common_transforms = [
-        transforms.Normalize(mean=cfg.dataset_mean, std=cfg.dataset_std, inplace=False),
         transforms.RandomFlip(ndim_spatial=2),
     ]
 
@@ -94,6 +102,16 @@ def main(cfg: DictConfig) -> None:
 
     train_transform = transforms.Compose(train_transform)
     valid_transform = transforms.Compose(valid_transform)
+    train_collate = valid_collate = batch_collate
+
+    if cfg.patchtrain.batch_augment:
+        # Same augmentations as above, but applied to whole batches in the collate functions
+        train_transform = valid_transform = transforms.Identity()
+        train_collate = BatchAugmentingCollate(
+            mean=cfg.dataset_mean, std=cfg.dataset_std,
+            affine_prob=0.9, rotate_limit=180, shift_limit=0.0, scale_limit=0.02,
+        )
+        valid_collate = BatchAugmentingCollate(mean=cfg.dataset_mean, std=cfg.dataset_std)
 
     # Specify data set
     train_dataset = EncPatchData(
@@ -103,6 +121,8 @@ def main(cfg: DictConfig) -> None:
         epoch_multiplier=5 if NEGATIVE_SAMPLING else 50,
         erase_mask_bg=ERASE_MASK_BG,
         erase_disk_mask_radius=ERASE_DISK_MASK_RADIUS,
+        num_decode_threads=cfg.patchtrain.num_decode_threads,
+        persist_patch_store=cfg.patchtrain.persist_patch_store,
     )
 
     valid_dataset = EncPatchData(
@@ -112,8 +132,17 @@ def main(cfg: DictConfig) -> None:
         epoch_multiplier=4 if NEGATIVE_SAMPLING else 10,
         erase_mask_bg=ERASE_MASK_BG,
         erase_disk_mask_radius=ERASE_DISK_MASK_RADIUS,
+        num_decode_threads=cfg.patchtrain.num_decode_threads,
+        persist_patch_store=cfg.patchtrain.persist_patch_store,
     )
 
+    if cfg.patchtrain.benchmark_data:
+        benchmark_data(
+            train_dataset, batch_size=batch_size, num_workers=cfg.patchtrain.num_workers,
+            num_batches=cfg.patchtrain.benchmark_batches, collate_fn=train_collate, device=device,
+        )
+        return
+
     # Set up optimization
     optimizer = optim.Adam(
         model.parameters(),
@@ -135,14 +164,14 @@ def main(cfg: DictConfig) -> None:
 
     inference_kwargs = {
         'apply_softmax': True,
-        'transform': valid_transform,
+        'transform': transforms.Compose([normalize]),  # Inference inputs are not normalized per batch
     }
 
     exp_name = cfg.segtrain.exp_name
     if exp_name is None:
         exp_name = ''
     timestamp = datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
-    exp_name = f'{exp_name}__{model.__class__.__name__ + "__" + timestamp}'
+    exp_name = f'{exp_name}__{model_name + "__" + timestamp}'
     exp_name = f'tr-{cfg.tr_group}_{exp_name}'
 
     # Create trainer
@@ -154,7 +183,7 @@ def main(cfg: DictConfig) -> None:
         train_dataset=train_dataset,
         valid_dataset=valid_dataset,
         batch_size=batch_size,
-        num_workers=8,
+        num_workers=cfg.patchtrain.num_workers,
         save_root=save_root,
         exp_name=exp_name,
         inference_kwargs=inference_kwargs,
@@ -162,10 +191,14 @@ def main(cfg: DictConfig) -> None:
         schedulers={"lr": lr_sched},
         valid_metrics=valid_metrics,
         out_channels=out_channels,
-        mixed_precision=True,
+        mixed_precision=device.type == 'cuda',
         extra_save_steps=list(range(10_000, max_steps + 1, 10_000)),
     )
 
+    # Datasets keep uint8 patches and don't normalize them, so normalize (and optionally augment) whole batches instead
+    set_collate_fn([trainer.train_loader], train_collate)
+    set_collate_fn([trainer.valid_loader], valid_collate)
+
     # Archiving training script, src folder, env info
     Backup(script_path=__file__, save_path=trainer.save_path).archive_backup()
 
@@ -31,7 +31,8 @@ from elektronn3.models.unet import UNet
 from elektronn3.modules.loss import CombinedLoss, DiceLoss
 from elektronn3.training import SWA, Backup, Trainer, metrics
 
-from emcaps.training.emcdata import EncSegData
+from emcaps.training.databench import benchmark_data, get_device
+from emcaps.training.emcdata import EncSegData, ToDtype
 
 
 
@@ -45,7 +46,7 @@ def main(cfg: DictConfig) -> None:
     random.seed(random_seed)
 
     torch.backends.cudnn.benchmark = True  # Improves overall performance in *most* cases
-    device = torch.device('cuda')
+    device = get_device(cfg.segtrain.device)
     print(f'Running on device: {device}')
 
     SHEET_NAME = 0  # index of sheet
@@ -73,9 +74,10 @@ def main(cfg: DictConfig) -> None:
     lr_dec = cfg.segtrain.lr_dec
     batch_size = cfg.segtrain.batch_size
 
-    # Transformations to be applied to samples before feeding them to the network
+    # Transformations to be applied to samples before feeding them to the network.
+    # The initial (512, 512) crop is sampled by EncSegData itself (see crop_shape below).
     common_transforms = [
-        transforms.RandomCrop((512, 512)),
+        ToDtype(np.float32),  # EncSegData yields uint8 images, only convert the crop
         transforms.Normalize(mean=cfg.dataset_mean, std=cfg.dataset_std, inplace=False),
         transforms.RandomFlip(ndim_spatial=2),
     ]
@@ -109,6 +111,10 @@ def main(cfg: DictConfig) -> None:
         target_dtype=target_dtype,
         enable_inputmask=INPUTMASK,
         epoch_multiplier=200,
+        image_cache_dir=cfg.segtrain.image_cache_dir,
+        crop_shape=(512, 512),
+        crop_fg_threshold=cfg.segtrain.crop_fg_threshold,
+        crop_fg_prob=cfg.segtrain.crop_fg_prob,
     )
 
     valid_dataset = EncSegData(
@@ -121,11 +127,20 @@ def main(cfg: DictConfig) -> None:
         target_dtype=target_dtype,
         enable_inputmask=INPUTMASK,
         epoch_multiplier=10,
+        image_cache_dir=cfg.segtrain.image_cache_dir,
+        crop_shape=(512, 512),  # Validation crops are always drawn uniformly
     )
 
     logger.info(f'Selected tr_group: {cfg.tr_group}')
     logger.info(f'Including images {list(train_dataset.meta.num.unique())}')
 
+    if cfg.segtrain.benchmark_data:
+        benchmark_data(
+            train_dataset, batch_size=batch_size, num_workers=cfg.segtrain.num_workers,
+            num_batches=cfg.segtrain.benchmark_batches, device=device,
+        )
+        return
+
     # Set up optimization
     optimizer = optim.Adam(
         model.parameters(),
@@ -169,7 +184,7 @@ def main(cfg: DictConfig) -> None:
         train_dataset=train_dataset,
         valid_dataset=valid_dataset,
         batch_size=batch_size,
-        num_workers=8,
+        num_workers=cfg.segtrain.num_workers,
         save_root=save_root,
         exp_name=exp_name,
         inference_kwargs=inference_kwargs,
@@ -177,7 +192,7 @@ def main(cfg: DictConfig) -> None:
         schedulers={"lr": lr_sched},
         valid_metrics=valid_metrics,
         out_channels=out_channels,
-        mixed_precision=True,
+        mixed_precision=device.type == 'cuda',
         extra_save_steps=list(range(40_000, max_steps + 1, 40_000)),
     )
 
@@ -0,0 +1,129 @@
+"""
+Two-stage (cascade) patch classification.
+
+A cheap feature-based prefilter (logistic regression on radial intensity
+profiles and disk radii) classifies all patches first. Only patches where the
+prefilter is not confident enough (low margin between the two most probable
+classes) are escalated to the CNN classifier.
+"""
+
+import logging
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from emcaps import utils
+from emcaps.utils import inference_utils as iu
+from emcaps.utils.patch_utils import get_radial_profiles, measure_inner_disk_radius, measure_outer_disk_radii
+
+
+logger = logging.getLogger('emcaps-cascade')
+
+
+def extract_radial_features(patches: np.ndarray) -> np.ndarray:
+    """Compute prefilter features for an (N, H, W) stack of background-erased patches.
+
+    Features are the radial intensity profile (scaled to [0, 1]) and the inner (r1)
+    and outer (r2) disk radii. Unmeasurable radii (NaN) are encoded as 0."""
+    patches = np.asarray(patches, dtype=np.float32)
+    profiles = get_radial_profiles(patches)
+    r1 = np.array([measure_inner_disk_radius(p) for p in profiles])
+    r2 = measure_outer_disk_radii(patches > 0)
+    radii = np.nan_to_num(np.stack((r1, r2), axis=1), nan=0.)
+    features = np.concatenate((profiles / 255., radii), axis=1)
+    return features
+
+
+class RadialProfilePrefilter:
+    """Cheap first cascade stage, see module docstring."""
+    def __init__(self, margin: float = 0.5, C: float = 1.0, max_iter: int = 1000):
+        self.margin = margin
+        self.model = make_pipeline(StandardScaler(), LogisticRegression(C=C, max_iter=max_iter))
+
+    @property
+    def class_ids(self) -> np.ndarray:
+        return self.model.classes_
+
+    def fit(self, patches: np.ndarray, targets: np.ndarray) -> 'RadialProfilePrefilter':
+        features = extract_radial_features(patches)
+        self.model.fit(features, targets)
+        return self
+
+    def predict_proba(self, patches: np.ndarray, allowed_classes=utils.CLASS_GROUPS['simple_hek']) -> np.ndarray:
+        """Return (N, K) probabilities for the K classes in self.class_ids, excluded classes are set to 0"""
+        features = extract_radial_features(patches)
+        probs = self.model.predict_proba(features)
+        allowed_class_ids = [utils.CLASS_IDS[cn] for cn in allowed_classes]
+        probs[:, ~np.isin(self.class_ids, allowed_class_ids)] = 0.
+        return probs
+
+    def predict(self, patches: np.ndarray, allowed_classes=utils.CLASS_GROUPS['simple_hek']):
+        """Return predicted class ids and a boolean mask of patches that need to be escalated"""
+        probs = self.predict_proba(patches, allowed_classes=allowed_classes)
+        top2 = np.sort(probs, axis=1)[:, -2:]
+        margins = top2[:, 1] - top2[:, 0]
+        preds = self.class_ids[np.argmax(probs, axis=1)]
+        escalate = margins < self.margin
+        return preds, escalate
+
+    def save(self, path: Path | str) -> None:
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: Path | str) -> 'RadialProfilePrefilter':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def cascade_classify(patches, prefilter, classifier_variant, allowed_classes=utils.CLASS_GROUPS['simple_hek'], tta=False):
+    """Classify patches with the prefilter and escalate low-margin patches to the CNN classifier.
+
+    Returns predicted class ids and the boolean escalation mask."""
+    patches = np.asarray(patches)
+    preds, escalate = prefilter.predict(patches, allowed_classes=allowed_classes)
+    if np.any(escalate):
+        preds[escalate] = iu.classify_patches(
+            patches[escalate], classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=tta
+        )
+    return preds, escalate
+
+
+def compare_cascade(patches, targets, prefilter, classifier_variant, allowed_classes=utils.CLASS_GROUPS['simple_hek'], tta=False):
+    """Run both CNN-only and cascade classification on the same patches and report timing and accuracy.
+
+    Returns a report dict and the cascade predictions."""
+    patches = np.asarray(patches)
+    targets = np.asarray(targets)
+    # Warm up so that one-time model loading does not count towards the first timing
+    iu.classify_patches(patches[:1], classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=tta)
+
+    t0 = time.perf_counter()
+    cnn_preds = iu.classify_patches(patches, classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=tta)
+    t_cnn = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    cascade_preds, escalate = cascade_classify(
+        patches, prefilter=prefilter, classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=tta
+    )
+    t_cascade = time.perf_counter() - t0
+
+    cnn_accuracy = iu.instance_accuracy(cnn_preds, targets)
+    cascade_accuracy = iu.instance_accuracy(cascade_preds, targets)
+    report = {
+        'n_patches': len(targets),
+        'escalation_rate': np.mean(escalate),
+        'margin': prefilter.margin,
+        't_cnn': t_cnn,
+        't_cascade': t_cascade,
+        'speedup': t_cnn / t_cascade,
+        'accuracy_cnn': cnn_accuracy,
+        'accuracy_cascade': cascade_accuracy,
+        'accuracy_diff': cascade_accuracy - cnn_accuracy,
+    }
+    return report, cascade_preds
@@ -9,12 +9,14 @@ import yaml
 from scipy import ndimage
 from skimage import morphology as sm
 from skimage.measure import regionprops
-from skimage.measure._regionprops import _props_to_dict
 from skimage.segmentation import clear_border
 from pathlib import Path
-from functools import lru_cache
+from functools import lru_cache, partial
 
-from emcaps.utils.patch_utils import measure_outer_disk_radius
+from emcaps.utils.region_utils import (
+    add_region_perimeters, iter_region_chunks, relabel_regions, select_candidate_regions,
+)
+from emcaps.utils.region_utils import calculate_circularity  # noqa: F401 (moved to region_utils, kept importable from here)
 from emcaps import utils
 
 
@@ -30,27 +32,6 @@ print(f'Running on {DEVICE}')
 DTYPE = torch.float16 if 'cuda' in str(DEVICE) else torch.float32
 
 
-# From https://github.com/napari/napari/blob/5cfcc38c0a313f42cc8b0f82ac3db945874ae362/examples/annotate_segmentation_with_text.py#L75
-def calculate_circularity(perimeter, area):
-    """Calculate the circularity of the region
-
-    Parameters
-    ----------
-    perimeter : float
-        the perimeter of the region
-    area : float
-        the area of the region
-
-    Returns
-    -------
-    circularity : float
-        The circularity of the region as defined by 4*pi*area / perimeter^2
-    """
-    circularity = 4 * np.pi * area / (perimeter ** 2)
-
-    return circularity
-
-
 # From https://github.com/napari/napari/blob/5cfcc38c0a313f42cc8b0f82ac3db945874ae362/examples/annotate_segmentation_with_text.py#L46
 def make_bbox(bbox_extents):
     """Get the coordinates of the corners of a
@@ -189,28 +170,76 @@ def check_image(img, normalized=False, shape=None):
         raise ImageError(f'{img.shape=}, but expected {shape}')
 
 
-def classify_patch(patch, classifier_variant, allowed_classes=utils.CLASS_GROUPS['simple_hek']):
+def dihedral_stack(x: torch.Tensor) -> torch.Tensor:
+    """Stack the 8 dihedral transforms (4 rotations, each with and without flip) of an
+    (N, C, H, W) batch into one (8 * N, C, H, W) batch, transform-major."""
+    rotations = [torch.rot90(x, k, dims=(2, 3)) for k in range(4)]
+    flipped = [rot.flip(3) for rot in rotations]
+    return torch.cat(rotations + flipped)
+
 
-    inp = normalize(patch)
+def classify_patches(patches, classifier_variant, allowed_classes=utils.CLASS_GROUPS['simple_hek'], batch_size=256, tta=False, return_probs=False):
+    """Classify an (N, H, W) stack of patches in batches.
+
+    If tta is true, the logits of all 8 dihedral transforms of each patch are
+    averaged (costs 8x the compute of a normal forward pass).
+
+    Returns an (N,) array of predicted class ids and, if return_probs is true,
+    also the (N, C) softmax outputs with excluded classes set to 0."""
+    patches = np.asarray(patches)
+    if patches.shape[0] == 0:
+        preds, probs = np.empty((0,), dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+        return (preds, probs) if return_probs else preds
+
+    inp = normalize(patches)
     check_image(inp, normalized=True)
 
     classifier_model = get_model(classifier_variant)
 
     allowed_class_ids = [utils.CLASS_IDS[cn] for cn in allowed_classes]
 
-    inp = torch.from_numpy(inp)[None, None].to(device=DEVICE, dtype=DTYPE)
+    probs = []
     with torch.inference_mode():
-        out = classifier_model(inp)
-        out = torch.softmax(out, 1)
-        # for c in range(out.shape[1]):
-        #     if not c in allowed_class_ids:
-        #         out[:, c] = 0.
-        excluded_class_ids = set(range(out.shape[1])) - set(allowed_class_ids)
-        for c in excluded_class_ids:
-            out[:, c] = 0.
-        pred = torch.argmax(out, dim=1)[0].item()
-        # pred -= 2 #p2
-    return pred
+        for i in range(0, inp.shape[0], batch_size):
+            binp = torch.from_numpy(inp[i:i + batch_size])[:, None].to(device=DEVICE, dtype=DTYPE)
+            if tta:
+                n = binp.shape[0]
+                out = classifier_model(dihedral_stack(binp))
+                out = out.view(8, n, -1).mean(0)  # Average logits over transforms
+            else:
+                out = classifier_model(binp)
+            out = torch.softmax(out, 1)
+            excluded_class_ids = list(set(range(out.shape[1])) - set(allowed_class_ids))
+            out[:, excluded_class_ids] = 0.
+            probs.append(out.float().cpu().numpy())
+    probs = np.concatenate(probs)
+    preds = np.argmax(probs, axis=1)
+    if return_probs:
+        return preds, probs
+    return preds
+
+
+def patch_targets(enctypes) -> np.ndarray:
+    """Target class ids of patches, given their enctype names (e.g. the enctype column of patch meta tables)"""
+    return np.array([utils.CLASS_IDS[enctype] for enctype in enctypes], dtype=np.int64)
+
+
+def instance_accuracy(preds, targets) -> float:
+    """Instance-level (per patch) classification accuracy"""
+    return float(np.mean(np.asarray(preds) == np.asarray(targets)))
+
+
+def classify_patch(patch, classifier_variant, allowed_classes=utils.CLASS_GROUPS['simple_hek'], tta=False):
+    pred = classify_patches(np.asarray(patch)[None], classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=tta)
+    return int(pred[0])
+
+
+# Builtin region properties that compute_rprops() can return in addition to its own measurements
+# (class_id, class_name, circularity, radius2, is_invalid).
+# perimeter and solidity are comparatively expensive, so they are only computed on request.
+RPROPS_AVAILABLE = ('label', 'bbox', 'area', 'centroid', 'perimeter', 'solidity')
+# Properties that are needed for save_properties_to_xlsx() and for drawing bounding boxes
+RPROPS_DEFAULT = ('label', 'bbox', 'area', 'centroid')
 
 
 def compute_rprops(
@@ -221,15 +250,14 @@ def compute_rprops(
     maxsize=None,
     noborder=False,
     min_circularity=0.8,
-    inplace_relabel=False,
     allowed_classes=utils.CLASS_GROUPS['simple_hek'],
     return_relabeled_seg=False,
     dilate_masks_by=5,
     ec_region_radius=24,
-
+    classifier_tta=False,
+    border_mode=None,
+    properties=RPROPS_DEFAULT,
 ):
-    # Code mainly redundant with / copied from patchifyseg. TODO: Refactor into shared function
-
     # Add 1 to high region coordinate in order to arrive at an odd number of pixels in each dimension
     EC_REGION_ODD_PLUS1 = 1
 
@@ -242,6 +270,10 @@ def compute_rprops(
     EC_MIN_AREA = minsize
     MIN_CIRCULARITY = min_circularity
 
+    unknown_properties = set(properties) - set(RPROPS_AVAILABLE)
+    if unknown_properties:
+        raise ValueError(f'Unknown region properties {unknown_properties}. Available: {RPROPS_AVAILABLE}')
+
     raw = image
 
     check_image(raw, normalized=False)
@@ -257,118 +289,68 @@ def compute_rprops(
     # label image regions
     cc, n_comps = ndimage.label(cleaned_lab)
 
-    rprops = regionprops(cc, raw)
-
-    # epropdict = {k: np.full((len(rprops),), np.nan) for k in extra_prop_names}
+    # Vectorized size, circularity and border filtering of all regions before any per-region work
+    rstats, region_indices = select_candidate_regions(
+        cc, n_comps, min_area=EC_MIN_AREA, max_area=EC_MAX_AREA, min_circularity=MIN_CIRCULARITY,
+        ec_region_radius=EC_REGION_RADIUS, odd_plus1=EC_REGION_ODD_PLUS1, border_mode=border_mode,
+    )
 
     epropdict = {
-        'class_id': np.empty((len(rprops),), dtype=np.uint8),
-        'class_name': ['?'] * len(rprops),
-        'circularity': np.empty((len(rprops),), dtype=np.float32),
-        'radius2': np.empty((len(rprops),), dtype=np.float32),
-        'is_invalid': np.empty((len(rprops),), dtype=bool),
+        # Placeholder for regions that are not classified. They are pruned (is_invalid) before returning.
+        'class_id': np.zeros((n_comps,), dtype=np.uint8),
+        'class_name': ['?'] * n_comps,
+        'circularity': np.round(rstats['circularity'], 2).astype(np.float32),
+        'radius2': np.full((n_comps,), np.nan, dtype=np.float32),
+        'is_invalid': np.ones((n_comps,), dtype=bool),  # Regions are marked as valid once they are classified
     }
 
+    classify_fn = partial(
+        classify_patches, classifier_variant=classifier_variant, allowed_classes=allowed_classes, tta=classifier_tta, return_probs=True
+    )
+    region_chunks = iter_region_chunks(
+        raw, cc, rstats, region_indices, ec_region_radius=EC_REGION_RADIUS, odd_plus1=EC_REGION_ODD_PLUS1,
+        dilate_masks_by=DILATE_MASKS_BY, border_mode=border_mode, classify_fn=classify_fn,
+    )
+    with tqdm.tqdm(total=len(region_indices), position=1, leave=True, desc='Analyzing regions', dynamic_ncols=True) as pbar:
+        for chunk in region_chunks:
+            if len(chunk.index) > 0:
+                check_image(chunk.nobg_patch, normalized=False, shape=(len(chunk.index), *PATCH_SHAPE))
+            epropdict['radius2'][chunk.index] = chunk.radius2
+            epropdict['is_invalid'][chunk.index] = False
+            epropdict['class_id'][chunk.index] = chunk.class_id
+            for i, class_id in zip(chunk.index, chunk.class_id):
+                epropdict['class_name'][i] = utils.CLASS_NAMES[class_id]
+            pbar.update(len(chunk.index))
+
     if return_relabeled_seg:
-        relabeled = lab.astype(np.uint8)
-
-    for i, rp in enumerate(tqdm.tqdm(rprops, position=1, leave=True, desc='Analyzing regions', dynamic_ncols=True)):
-        is_invalid = False
-        centroid = np.round(rp.centroid).astype(np.int64)  # Note: This centroid is in the global coordinate frame
-        if rp.area < EC_MIN_AREA or rp.area > EC_MAX_AREA:
-            logger.info(f'Skipping: area size {rp.area} not within [{EC_MIN_AREA}, {EC_MAX_AREA}]')
-            is_invalid = True
-            continue  # Too small or too big (-> background component?) to be a normal particle
-        circularity = np.nan
-        if MIN_CIRCULARITY > 0:
-            circularity = calculate_circularity(rp.perimeter, rp.area)
-            if circularity < MIN_CIRCULARITY:
-                logger.info(f'Skipping: circularity {circularity} below {MIN_CIRCULARITY}')
-                is_invalid = True
-                continue  # Not circular enough (probably a false merger)
-            circularity = np.round(circularity, 2)  # Round for more readable logging
-
-        lo = centroid - EC_REGION_RADIUS
-        hi = centroid + EC_REGION_RADIUS + EC_REGION_ODD_PLUS1
-        if np.any(lo < 0) or np.any(hi > raw.shape):
-            logger.info(f'Skipping: region touches border')
-            is_invalid = True
-            continue  # Too close to image border
-
-        xslice = slice(lo[0], hi[0])
-        yslice = slice(lo[1], hi[1])
-
-        raw_patch = raw[xslice, yslice]
-        # mask_patch = mask[xslice, yslice]
-        # For some reason mask[xslice, yslice] does not always contain nonzero values, but cc at the same slice does.
-        # So we rebuild the mask at the region slice by comparing cc to 0
-        mask_patch = cc[xslice, yslice] > 0
-
-
-        # Eliminate coinciding masks from other particles that can overlap with this region (this can happen because we slice the mask_patch from the global mask)
-        _mask_patch_cc, _ = ndimage.label(mask_patch)
-        # Assuming convex particles, the center pixel is always on the actual mask region of interest.
-        _local_center = np.round(np.array(mask_patch.shape) / 2).astype(np.int64)
-        _mask_patch_centroid_label = _mask_patch_cc[tuple(_local_center)]
-        # All mask_patch pixels that don't share the same cc label as the centroid pixel are set to 0
-        mask_patch[_mask_patch_cc != _mask_patch_centroid_label] = 0
-
-        if mask_patch.sum() == 0:
-            # No positive pixel in mask -> skip this one
-            logger.info(f'Skipping: no particle mask in region')
-            # TODO: Why does this happen although we're iterating over regionprops from mask?
-            # (Only happens if using `mask_patch = mask[xslice, yslice]`. Workaround: `Use mask_patch = cc[xslice, yslice] > 0`)
-            is_invalid = True
-            continue
-
-        area = int(np.sum(mask_patch))
-        radius2 = np.round(measure_outer_disk_radius(mask_patch, discrete=False), 1)
-
-        # Enlarge masks because we don't want to risk losing perimeter regions
-        if DILATE_MASKS_BY > 0:
-            disk = sm.disk(DILATE_MASKS_BY)
-            # mask_patch = ndimage.binary_dilation(mask_patch, iterations=DILATE_MASKS_BY)
-            mask_patch = sm.binary_dilation(mask_patch, footprint=disk)
-
-        # Measure again after mask dilation
-        area_dilated = int(np.sum(mask_patch))
-        radius2_dilated = np.round(measure_outer_disk_radius(mask_patch, discrete=False), 1)
-
-        # Raw patch with background erased via mask
-        nobg_patch = raw_patch.copy()
-        nobg_patch[mask_patch == 0] = 0
-
-        check_image(nobg_patch, normalized=False, shape=PATCH_SHAPE)
-
-        class_id = classify_patch(patch=nobg_patch, classifier_variant=classifier_variant, allowed_classes=allowed_classes)
-        class_name = utils.CLASS_NAMES[class_id]
-
-        if not is_invalid:
-            if return_relabeled_seg:
-                relabeled[tuple(rp.coords.T)] = class_id
-            if inplace_relabel:
-                # This feels (morally) wrong but it seems to work.
-                # Overwrite lab argument from caller by writing back into original memory
-                lab[tuple(rp.coords.T)] = class_id
-
-        # # Attribute assignments don't stick for _props_to_dict() for some reason
-        # rp.class_id = class_id
-        # rp.class_name = class_name
-        # rp.circularity = circularity
-        # rp.radius2 = radius2
-
-        epropdict['class_id'][i] = class_id
-        epropdict['class_name'][i] = class_name
-        epropdict['circularity'][i] = circularity
-        epropdict['radius2'][i] = radius2
-        epropdict['is_invalid'][i] = is_invalid
-
-        # iio.imwrite('/tmp/nobg-{i:03d}.png', nobg_patch)
-
-    # Can only assign builtin props here
-    propdict = _props_to_dict(
-        rprops, properties=['label', 'bbox', 'perimeter', 'area', 'solidity', 'centroid']
-    ) if len(rprops) > 0 else {}
+        # Class map: classified regions get their class id, invalid regions and background become 0.
+        # Returned as a new array, the lab argument is never modified.
+        is_classified = ~epropdict['is_invalid']
+        relabeled = relabel_regions(cc, n_comps, np.flatnonzero(is_classified), epropdict['class_id'][is_classified], dtype=np.uint8)
+
+    is_valid = ~epropdict['is_invalid']
+    if 'perimeter' in properties and MIN_CIRCULARITY <= 0:
+        add_region_perimeters(rstats, cc, is_valid)
+
+    # Builtin props from the vectorized region stats
+    propdict = {}
+    if 'label' in properties:
+        propdict['label'] = rstats['label']
+    if 'bbox' in properties:
+        propdict.update({f'bbox-{j}': rstats['bbox'][:, j] for j in range(4)})
+    if 'perimeter' in properties:
+        propdict['perimeter'] = rstats['perimeter']
+    if 'area' in properties:
+        propdict['area'] = rstats['area']
+    if 'centroid' in properties:
+        propdict.update({f'centroid-{j}': rstats['centroid'][:, j] for j in range(2)})
+    if 'solidity' in properties:
+        # Convex hulls are only computed for regions that passed all filters
+        solidity = np.full((n_comps,), np.nan)
+        rprops = regionprops(cc)
+        for i in np.flatnonzero(is_valid):
+            solidity[i] = rprops[i].solidity
+        propdict['solidity'] = solidity
 
     propdict.update(epropdict)
 
@@ -384,12 +366,11 @@ def compute_rprops(
     return propdict
 
 
-def save_properties_to_xlsx(properties: dict, xlsx_out_path: Path) -> None:
+def properties_to_frame(properties: dict) -> Optional[pd.DataFrame]:
+    """Region table with the columns of interest from compute_rprops() properties (None if there are no regions)"""
     if not properties or properties['class_id'].size == 0:
-        logger.debug('properties empty -> not saving .xlsx file')
-        return
-    xlsx_out_path = xlsx_out_path.expanduser()
-    # Create a dataframe from properties for saving to an .xlsx file
+        return None
+    # Create a dataframe from properties for saving to a table file
     propframe = pd.DataFrame(properties)
     propframe = propframe.round(2)  # Round every float entry to 2 decimal places
     propframe.rename(columns={'label': 'region_id'}, inplace=True)  # Rename misleading column for conn. comp. id
@@ -400,11 +381,30 @@ def save_properties_to_xlsx(properties: dict, xlsx_out_path: Path) -> None:
                        [f'centroid-{i}' for i in range(2)] +\
                        [f'bbox-{i}' for i in range(4)]
     propframe = propframe[selected_columns]
+    return propframe
+
+
+def save_properties_to_xlsx(properties: dict, xlsx_out_path: Path) -> None:
+    propframe = properties_to_frame(properties)
+    if propframe is None:
+        logger.debug('properties empty -> not saving .xlsx file')
+        return
+    xlsx_out_path = xlsx_out_path.expanduser()
     logger.info(f'Writing output to {xlsx_out_path}')
     # Save to spreadsheet
     propframe.to_excel(xlsx_out_path, sheet_name='emcaps-regions', index=False)
 
 
+def save_properties_table(properties: dict, out_path: Path, xlsx_export: bool = False) -> None:
+    """Save region properties as .parquet table (see utils.write_table()), optionally also as .xlsx file"""
+    propframe = properties_to_frame(properties)
+    if propframe is None:
+        logger.debug('properties empty -> not saving region table')
+        return
+    out_path = utils.write_table(propframe, out_path, xlsx_export=xlsx_export)
+    logger.info(f'Wrote region table to {out_path}')
+
+
 def compute_majority_class_name(class_preds):
     majority_class = np.argmax(np.bincount(class_preds))
     majority_class_name = assign_class_names([majority_class])[0]
@@ -0,0 +1,226 @@
+"""
+Single-container storage for patch datasets (as produced by patchifyseg.py).
+
+A patch dataset stores four small PNG files per particle (raw/, mask/, nobg/ and
+cavg/). The patch store holds the same images as one uint8 .npy stack per kind,
+which can be memory-mapped and sliced instead of decoding every file on its own.
+Row i of each stack holds the patch with patch_id i, so stacks are aligned with
+the patch ids that are encoded in the patch_fname column of patch meta sheets
+(e.g. raw_patch_000123.png -> row 123). Rows of patch ids that don't exist
+(e.g. after incremental runs dropped some patches) are zero.
+
+Layout inside the patch dataset directory:
+
+    patchstore/{kind}.npy  (N, H, W) uint8 stack for each kind
+    patchstore/patch_ids.npy  (M,) int64 ids of all patches that are present in the stacks
+"""
+
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Sequence
+
+import hydra
+import imageio.v3 as iio
+import numpy as np
+import tqdm
+from omegaconf import DictConfig
+
+from emcaps.utils.utils import read_table
+
+
+logger = logging.getLogger('emcaps-patch-store')
+
+# Kinds of patch images that are written for each particle, each one to its own subdirectory
+PATCH_KINDS = ('raw', 'mask', 'nobg', 'cavg')
+
+STORE_DIRNAME = 'patchstore'
+
+_PATCH_ID_RE = re.compile(r'_patch_(\d+)\.png$')
+
+
+def patch_id_from_fname(fname: str) -> int:
+    """Parse the patch id from a patch file name, e.g. raw_patch_000123.png -> 123"""
+    match = _PATCH_ID_RE.search(str(fname))
+    if match is None:
+        raise ValueError(f'Can\'t parse patch id from file name {fname}')
+    return int(match.group(1))
+
+
+def get_store_path(patch_root: Path | str) -> Path:
+    return Path(patch_root) / STORE_DIRNAME
+
+
+def has_patch_store(patch_root: Path | str, kinds: Iterable[str] = ('raw',)) -> bool:
+    store_path = get_store_path(patch_root)
+    return all((store_path / f'{kind}.npy').is_file() for kind in kinds)
+
+
+class PatchStore:
+    """Read access to the memory-mapped patch stacks of one patch dataset"""
+    def __init__(self, patch_root: Path | str):
+        self.path = get_store_path(patch_root)
+        if not self.path.is_dir():
+            raise FileNotFoundError(f'No patch store found in {patch_root}')
+        self.patch_ids = np.load(self.path / 'patch_ids.npy')
+        self._stacks: Dict[str, np.ndarray] = {}
+
+    def stack(self, kind: str) -> np.ndarray:
+        """Memory-mapped (N, H, W) stack of a patch kind, indexed by patch id"""
+        if kind not in self._stacks:
+            self._stacks[kind] = np.load(self.path / f'{kind}.npy', mmap_mode='r')
+        return self._stacks[kind]
+
+    @staticmethod
+    def ids(fnames: Sequence[str]) -> np.ndarray:
+        """Stack indices (patch ids) of patch file names"""
+        return np.array([patch_id_from_fname(fname) for fname in fnames], dtype=np.int64)
+
+    def contains(self, fnames: Sequence[str]) -> bool:
+        """Check if all patches with the given file names are present in the store"""
+        return bool(np.all(np.isin(self.ids(fnames), self.patch_ids)))
+
+    def get(self, kind: str, fnames: Sequence[str]) -> np.ndarray:
+        """Read the patches with the given file names (of any kind) into a new (len(fnames), H, W) array"""
+        return np.asarray(self.stack(kind)[self.ids(fnames)])
+
+
+def open_patch_store(patch_root: Path | str, kinds: Iterable[str] = ('raw',), fnames: Optional[Sequence[str]] = None) -> Optional[PatchStore]:
+    """Open the patch store of a patch dataset if it has all kinds (and contains all fnames if given), else return None"""
+    if not has_patch_store(patch_root, kinds=kinds):
+        return None
+    store = PatchStore(patch_root)
+    if fnames is not None and not store.contains(fnames):
+        return None
+    return store
+
+
+def load_patches(
+        patch_root: Path | str,
+        kind: str,
+        fnames: Sequence[str],
+        imread: Callable = iio.imread,
+        num_threads: int = 1,
+) -> np.ndarray:
+    """Load patches of one kind as an (N, H, W) uint8 array.
+
+    fnames are raw patch file names, as found in the patch_fname column of patch meta sheets.
+    If the patch dataset has a patch store that contains them, patches are read from it, else each PNG
+    file is decoded (in num_threads parallel threads)."""
+    fnames = list(fnames)
+    store = open_patch_store(patch_root, kinds=[kind], fnames=fnames)
+    if store is not None:
+        return store.get(kind, fnames)
+    patch_root = Path(patch_root)
+    if len(fnames) == 0:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    paths = [patch_root / kind / fname.replace('raw', kind) for fname in fnames]
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return np.stack(list(executor.map(imread, paths)))
+    return np.stack([imread(path) for path in paths])
+
+
+def store_patches(patch_root: Path | str, fnames: Sequence[str], kinds: Sequence[str] = PATCH_KINDS, num_threads: int = 1) -> Optional[PatchStore]:
+    """Decode the PNG files of the given patches and persist them as the patch store of the patch dataset,
+    so the next runs can memory-map them.
+
+    Persisting is additive: If the patch dataset already has a patch store that contains all fnames, only the
+    kinds that it doesn't have yet are added and its other stacks are kept. If the existing patch store doesn't
+    contain all fnames, it is left untouched and None is returned."""
+    fnames = list(fnames)
+    store_path = get_store_path(patch_root)
+    if (store_path / 'patch_ids.npy').is_file():
+        store = PatchStore(patch_root)
+        if not store.contains(fnames):
+            logger.warning(f'Existing patch store {store_path} doesn\'t contain all patches, not modifying it')
+            return None
+        kinds = [kind for kind in kinds if not (store_path / f'{kind}.npy').is_file()]
+        if len(kinds) == 0:
+            return store
+        # New stacks have to be aligned with the existing ones, so decode all patches of the store
+        fnames = [f'raw_patch_{patch_id:06d}.png' for patch_id in store.patch_ids]
+    positions = {patch_id: i for i, patch_id in enumerate(PatchStore.ids(fnames))}
+    stacks = {kind: load_patches(patch_root, kind, fnames, num_threads=num_threads) for kind in kinds}
+
+    def read_patch(kind: str, patch_id: int) -> np.ndarray:
+        return stacks[kind][positions[patch_id]]
+
+    write_patch_store(patch_root, list(positions.keys()), read_patch, kinds=kinds, replace=False)
+    return PatchStore(patch_root)
+
+
+def write_patch_store(
+        patch_root: Path | str,
+        patch_ids: Sequence[int],
+        read_patch: Callable[[str, int], np.ndarray],
+        kinds: Sequence[str] = PATCH_KINDS,
+        replace: bool = True,
+) -> None:
+    """Write a patch store for patch_ids, reading each patch image with read_patch(kind, patch_id).
+
+    If replace is true, an existing patch store is replaced. Else, only the stacks of the given kinds
+    are (over)written and other stacks are kept. This requires the existing store to have the same patch ids."""
+    store_path = get_store_path(patch_root)
+    patch_ids = np.sort(np.asarray(patch_ids, dtype=np.int64))
+    if replace or not (store_path / 'patch_ids.npy').is_file():
+        remove_patch_store(patch_root)  # Don't keep stacks that are not aligned with the new patch ids
+        store_path.mkdir()
+    elif not np.array_equal(np.load(store_path / 'patch_ids.npy'), patch_ids):
+        raise ValueError(f'Can\'t add stacks to patch store {store_path} because its patch ids differ')
+    n = int(patch_ids.max()) + 1 if len(patch_ids) > 0 else 0
+    for kind in kinds:
+        tmp_path = store_path / f'{kind}.tmp.npy'
+        stack = None
+        for patch_id in tqdm.tqdm(patch_ids, desc=kind, dynamic_ncols=True):
+            patch = read_patch(kind, int(patch_id))
+            if stack is None:
+                stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(n, *patch.shape))
+            stack[patch_id] = patch
+        if stack is None:  # No patches
+            stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(0, 0, 0))
+        stack.flush()
+        del stack
+        tmp_path.replace(store_path / f'{kind}.npy')
+    np.save(store_path / 'patch_ids.npy', patch_ids)
+    logger.info(f'Wrote patch store with {len(patch_ids)} patches ({", ".join(kinds)}) to {store_path}')
+
+
+def convert_png_dataset(patch_root: Path | str, patchmeta_path: Optional[Path | str] = None, kinds: Optional[Sequence[str]] = None) -> None:
+    """Convert the PNG files of an existing patch dataset (as listed in its patchmeta table) to a patch store.
+
+    By default, all kinds for which a subdirectory exists are converted."""
+    patch_root = Path(patch_root)
+    if patchmeta_path is None:
+        patchmeta_path = patch_root / 'patchmeta.parquet'
+    if kinds is None:
+        kinds = [kind for kind in PATCH_KINDS if (patch_root / kind).is_dir()]
+    patchmeta = read_table(patchmeta_path)
+    patch_ids = [patch_id_from_fname(fname) for fname in patchmeta.patch_fname]
+
+    def read_patch(kind: str, patch_id: int) -> np.ndarray:
+        return iio.imread(patch_root / kind / f'{kind}_patch_{patch_id:06d}.png')
+
+    write_patch_store(patch_root, patch_ids, read_patch, kinds=kinds)
+
+
+def remove_patch_store(patch_root: Path | str) -> None:
+    """Remove the patch store of a patch dataset (e.g. because its PNG files changed)"""
+    store_path = get_store_path(patch_root)
+    if store_path.is_dir():
+        for path in store_path.iterdir():
+            path.unlink()
+        store_path.rmdir()
+        logger.info(f'Removed outdated patch store {store_path}')
+
+
+@hydra.main(version_base='1.2', config_path='../conf', config_name='config')
+def main(cfg: DictConfig) -> None:
+    """Convert the PNG patch dataset in cfg.patchifyseg.patch_out_path to a patch store"""
+    patch_root = Path(cfg.patchifyseg.patch_out_path).expanduser()
+    convert_png_dataset(patch_root)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,16 @@ Requires a directory with patch images in the `patch_path`, which can be
 built with eclassify_analysis.py.
 """
 
+from functools import lru_cache
+
 import matplotlib.pyplot as plt
 import numpy as np
 import imageio.v3 as iio
 from pathlib import Path
+from scipy import sparse
 from scipy.interpolate import interp1d
-from skimage.transform import rotate
+from skimage.transform import SimilarityTransform, rotate
+from skimage.util import img_as_float
 import tqdm
 import seaborn as sns
 
@@ -38,6 +42,41 @@ def get_radial_profile(img: np.ndarray, center=None, half=True) -> np.ndarray:
     return radialprofile
 
 
+@lru_cache(maxsize=8)
+def _radius_index(shape: tuple, center: tuple) -> tuple:
+    """Integer radius bin of each pixel (flattened), number of bins and pixel count per bin for a given image shape and center.
+
+    Cached because it only depends on the patch shape, which is the same for all patches."""
+    y, x = np.indices(shape)
+    r = np.sqrt((x - center[0])**2 + (y - center[1])**2)
+    r = r.astype(np.int64).ravel()
+    nbins = r.max() + 1
+    nr = np.bincount(r, minlength=nbins)
+    r.flags.writeable = False
+    nr.flags.writeable = False
+    return r, nbins, nr
+
+
+def get_radial_profiles(imgs: np.ndarray, center=None, half=True) -> np.ndarray:
+    """Batched version of get_radial_profile() for an (N, H, W) image stack.
+
+    Returns an (N, R) array of radial profiles that match get_radial_profile()
+    results for each individual image."""
+    n = imgs.shape[0]
+    shape = imgs.shape[1:]
+    if center is None:
+        center = np.array(shape) // 2 - 1
+    r, nbins, nr = _radius_index(tuple(shape), tuple(int(c) for c in center))
+    # Offset radius bins per image so that one bincount call covers the whole stack
+    rs = (r[None] + np.arange(n)[:, None] * nbins).ravel()
+
+    tbin = np.bincount(rs, imgs.reshape(n, -1).ravel(), minlength=n * nbins).reshape(n, nbins)
+    radialprofiles = tbin / nr
+    if half:
+        radialprofiles = radialprofiles[:, :shape[0] // 2]
+    return radialprofiles
+
+
 def measure_inner_disk_radius(hprofile, center_nhood=2, discrete=False):
     # TODO: gaussian filtering?
     # Look for actual encapsulin center in the patch by finding intensity maximum in a `center_nhood` neighborhood around the central pixel
@@ -101,6 +140,37 @@ def measure_outer_disk_radius(mask: np.ndarray, discrete: bool = False) -> float
     return outer_radius
 
 
+def measure_outer_disk_radii(masks: np.ndarray, discrete: bool = False) -> np.ndarray:
+    """Batched version of measure_outer_disk_radius() for an (N, H, W) stack of masks.
+
+    Returns an (N,) float array with the same values (including NaNs) as measure_outer_disk_radius() on each mask."""
+    profiles = get_radial_profiles(masks)
+    n = profiles.shape[0]
+    rows = np.arange(n)
+    y = 0.5
+    # Same crossing search as in measure_outer_disk_radius(), for all profiles at once.
+    # A left index of -1 wraps around to the last profile value, as in the scalar version.
+    right_x = np.argmax(profiles <= y, axis=1)
+    left_x = right_x - 1
+    if discrete:
+        outer_radius = left_x.astype(np.float64)
+    else:
+        right_y = profiles[rows, right_x]
+        left_y = profiles[rows, left_x]
+        # Inverse linear interpolation with the same case distinction and arithmetic as
+        # np.interp(y, [right_y, left_y], [right_x, left_x])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (left_x - right_x) / (left_y - right_y)
+            outer_radius = np.where(
+                y < right_y, right_x,
+                np.where(y >= left_y, left_x, slope * (y - right_y) + right_x)
+            ).astype(np.float64)
+        # Intensity goes back up again -> fail
+        outer_radius[right_y > left_y] = np.nan
+    outer_radius[outer_radius < 3] = np.nan  # Not plausible
+    return outer_radius
+
+
 # Based on https://stackoverflow.com/a/36502578
 def _centered_distance_matrix(n):
     assert n % 2 == 1, "make sure n is odd" # -> can this be relaxed here?
@@ -149,18 +219,103 @@ def get_rotations(img, steps=360):
     return rotated_imgs
 
 
-def concentric_average(img, steps=360):
+def concentric_average_reference(img, steps=360):
+    """Rotation-based reference implementation of concentric_average() (slow)"""
     rotated_imgs = get_rotations(img=img, steps=steps)
     avg = rotated_imgs.mean(0)
     return avg
 
 
-def concentric_max(img, steps=360):
+def concentric_max_reference(img, steps=360):
+    """Rotation-based reference implementation of concentric_max() (slow)"""
     rotated_imgs = get_rotations(img=img, steps=steps)
     avg = rotated_imgs.max(0)
     return avg
 
 
+@lru_cache(maxsize=4)
+def _rotation_sampling_matrix(shape: tuple, steps: int) -> sparse.csr_matrix:
+    """Sparse (steps * H * W, H * W) matrix that maps a flattened image to all of its rotations.
+
+    Row a * H * W + p holds the bilinear interpolation weights of output pixel p of the image
+    rotated by the a-th angle, with the same coordinate mapping as skimage.transform.rotate()
+    with default arguments (rotation around the image center, constant 0 outside of the image)."""
+    rows, cols = shape
+    center = np.array((cols, rows)) / 2.0 - 0.5
+    rr, cc = np.indices(shape)
+    rr, cc = rr.ravel(), cc.ravel()
+    out_idx = np.arange(rows * cols)
+    mat_rows, mat_cols, weights = [], [], []
+    for a, angle in enumerate(np.linspace(0, 360, num=steps, endpoint=False)):
+        tform = SimilarityTransform(translation=-center) + SimilarityTransform(rotation=np.deg2rad(angle)) + SimilarityTransform(translation=center)
+        m = tform.params
+        # Input coordinates of each output pixel
+        x = m[0, 0] * cc + m[0, 1] * rr + m[0, 2]
+        y = m[1, 0] * cc + m[1, 1] * rr + m[1, 2]
+        r0, c0 = np.floor(y), np.floor(x)
+        r1, c1 = np.ceil(y), np.ceil(x)
+        dr, dc = y - r0, x - c0
+        for nr, nc, w in [
+            (r0, c0, (1 - dr) * (1 - dc)),
+            (r0, c1, (1 - dr) * dc),
+            (r1, c0, dr * (1 - dc)),
+            (r1, c1, dr * dc),
+        ]:
+            # Neighbors outside of the image contribute 0 (constant mode) and are left out
+            valid = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols) & (w != 0)
+            mat_rows.append(a * rows * cols + out_idx[valid])
+            mat_cols.append((nr[valid] * cols + nc[valid]).astype(np.int64))
+            weights.append(w[valid])
+    return sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(mat_rows), np.concatenate(mat_cols))),
+        shape=(steps * rows * cols, rows * cols),
+    )
+
+
+@lru_cache(maxsize=4)
+def _concentric_average_matrix(shape: tuple, steps: int) -> sparse.csr_matrix:
+    """Sparse (H * W, H * W) matrix that maps a flattened image to its concentric average"""
+    n = shape[0] * shape[1]
+    sampling = _rotation_sampling_matrix(shape, steps)
+    return sparse.csr_matrix(sum(sampling[a * n:(a + 1) * n] for a in range(steps)) / steps)
+
+
+def concentric_averages(imgs: np.ndarray, steps: int = 360) -> np.ndarray:
+    """Average over `steps` rotations of each image of an (N, H, W) stack, computed as one sparse matrix product.
+
+    Agrees with concentric_average_reference() on each image up to floating point
+    rounding (skimage computes float32 inputs in float32, this is always computed in float64)."""
+    imgs = img_as_float(np.asarray(imgs))  # Same intensity scaling as skimage.transform.rotate()
+    n, h, w = imgs.shape
+    flat = imgs.reshape(n, h * w).astype(np.float64)
+    avg = (_concentric_average_matrix((h, w), steps) @ flat.T).T
+    return avg.reshape(n, h, w)
+
+
+def concentric_maxes(imgs: np.ndarray, steps: int = 360, chunk_size: int = 16) -> np.ndarray:
+    """Maximum over `steps` rotations of each image of an (N, H, W) stack.
+
+    All rotations of a chunk of images are sampled with one sparse matrix product.
+    Agrees with concentric_max_reference() up to floating point rounding."""
+    imgs = img_as_float(np.asarray(imgs))
+    n, h, w = imgs.shape
+    flat = imgs.reshape(n, h * w).astype(np.float64)
+    sampling = _rotation_sampling_matrix((h, w), steps)
+    out = np.empty((n, h * w), dtype=np.float64)
+    for i in range(0, n, chunk_size):
+        rotated = sampling @ flat[i:i + chunk_size].T  # (steps * H * W, chunk)
+        out[i:i + chunk_size] = rotated.reshape(steps, h * w, -1).max(0).T
+    return out.reshape(n, h, w)
+
+
+def concentric_average(img, steps=360):
+    return concentric_averages(np.asarray(img)[None], steps=steps)[0]
+
+
+def concentric_max(img, steps=360):
+    return concentric_maxes(np.asarray(img)[None], steps=steps)[0]
+
+
 if __name__ == '__main__':
     patch_path = Path('~/tum/patches_v2_hek_enctype_prefix/raw/').expanduser()
     mask_path = patch_path.parent / 'mask'
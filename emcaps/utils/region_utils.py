@@ -0,0 +1,430 @@
+"""
+Vectorized region analysis utilities.
+
+The functions here operate on all connected components of a label image at
+once instead of iterating over skimage regionprops in Python.
+"""
+
+import logging
+from functools import lru_cache
+from math import sqrt
+from typing import Callable, Iterator, NamedTuple
+
+import numpy as np
+from scipy import ndimage
+from skimage import morphology as sm
+
+from emcaps.utils.patch_utils import measure_outer_disk_radii
+
+
+logger = logging.getLogger('emcaps-region-utils')
+
+
+# Perimeter estimation weights and kernel from skimage.measure.perimeter() (4-neighborhood)
+_PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+_PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+_PERIMETER_WEIGHTS[[21, 33]] = sqrt(2)
+_PERIMETER_WEIGHTS[[13, 23]] = (1 + sqrt(2)) / 2
+# (row offset, column offset, kernel weight) of the 8 neighbors in the perimeter kernel [[10, 2, 10], [2, 1, 2], [10, 2, 10]]
+_PERIMETER_NEIGHBORS = [
+    (-1, -1, 10), (-1, 0, 2), (-1, 1, 10),
+    (0, -1, 2), (0, 1, 2),
+    (1, -1, 10), (1, 0, 2), (1, 1, 10),
+]
+_4_NEIGHBORS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+
+# From https://github.com/napari/napari/blob/5cfcc38c0a313f42cc8b0f82ac3db945874ae362/examples/annotate_segmentation_with_text.py#L75
+def calculate_circularity(perimeter, area):
+    """Calculate the circularity of the region
+
+    Parameters
+    ----------
+    perimeter : float
+        the perimeter of the region
+    area : float
+        the area of the region
+
+    Returns
+    -------
+    circularity : float
+        The circularity of the region as defined by 4*pi*area / perimeter^2
+    """
+    circularity = 4 * np.pi * area / (perimeter ** 2)
+
+    return circularity
+
+
+def _shifted(padded: np.ndarray, dr: int, dc: int, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Look up values of a 1-padded array at (rows + dr, cols + dc) in unpadded coordinates"""
+    return padded[rows + 1 + dr, cols + 1 + dc]
+
+
+def compute_region_perimeters(cc: np.ndarray, n_comps: int, regions: np.ndarray | None = None) -> np.ndarray:
+    """Compute perimeters of all regions in the label image cc at once.
+
+    Equivalent to skimage.measure.regionprops(cc)[i].perimeter (4-neighborhood),
+    which analyzes each region in isolation: Border pixels are region pixels with
+    at least one 4-neighbor that is not part of the same region and only border
+    pixels of the same region contribute to the weighted neighborhood counts.
+
+    If regions (boolean mask indexed by label - 1) is given, only these regions
+    are measured and the other perimeters are NaN."""
+    padded = np.pad(cc, 1)
+    rows, cols = np.nonzero(cc)
+    labels = cc[rows, cols]
+    if regions is not None:
+        selected = regions[labels - 1]
+        rows, cols, labels = rows[selected], cols[selected], labels[selected]
+    is_border = np.zeros(labels.shape, dtype=bool)
+    for dr, dc in _4_NEIGHBORS:
+        is_border |= _shifted(padded, dr, dc, rows, cols) != labels
+    rows, cols, labels = rows[is_border], cols[is_border], labels[is_border]
+
+    # Only keep border pixels in the padded label image, so neighbor comparisons only match same-region border pixels
+    border_padded = np.zeros_like(padded)
+    border_padded[rows + 1, cols + 1] = labels
+    values = np.ones(labels.shape, dtype=np.int64)  # Center weight 1
+    for dr, dc, weight in _PERIMETER_NEIGHBORS:
+        values += weight * (_shifted(border_padded, dr, dc, rows, cols) == labels)
+
+    hist = np.bincount(labels.astype(np.int64) * 50 + values, minlength=(n_comps + 1) * 50)
+    hist = hist.reshape(n_comps + 1, 50)[1:]
+    # Row-wise dot products instead of one matrix-vector product, to reproduce
+    # skimage's floating point summation order exactly (filter decisions must not change)
+    perimeters = np.full((n_comps,), np.nan)
+    indices = np.arange(n_comps) if regions is None else np.flatnonzero(regions)
+    for i in indices:
+        perimeters[i] = hist[i] @ _PERIMETER_WEIGHTS
+    return perimeters
+
+
+def add_region_perimeters(stats: dict, cc: np.ndarray, regions: np.ndarray | None = None) -> None:
+    """Measure perimeters and circularities of the regions selected by the boolean mask regions
+    (all if None) and write them into the region stats (see compute_region_stats()) in place"""
+    perimeters = compute_region_perimeters(cc, len(stats['label']), regions=regions)
+    if regions is not None:
+        perimeters = np.where(regions, perimeters, stats['perimeter'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['circularity'] = calculate_circularity(perimeters, stats['area'])
+    stats['perimeter'] = perimeters
+
+
+def compute_region_stats(cc: np.ndarray, n_comps: int | None = None, perimeter: bool = True) -> dict:
+    """Compute basic statistics of all regions (labels 1 to n_comps) of the label image cc at once.
+
+    Returns a dict of arrays with one entry per region, ordered by label:
+
+    - label: (N,) region label
+    - area: (N,) pixel count
+    - centroid: (N, 2) centroid (row, column), same as regionprops centroid
+    - bbox: (N, 4) bounding box (min_row, min_col, max_row, max_col), same as regionprops bbox
+    - perimeter: (N,) perimeter estimate, same as regionprops perimeter (NaN if perimeter=False)
+    - circularity: (N,) circularity computed from area and perimeter (NaN if perimeter=False)
+
+    Perimeters are the most expensive part. With perimeter=False, they can be
+    added later for a subset of regions with add_region_perimeters().
+    """
+    if n_comps is None:
+        n_comps = int(cc.max())
+    flat = cc.ravel()
+    labels = np.arange(1, n_comps + 1)
+    area = np.bincount(flat, minlength=n_comps + 1)[1:n_comps + 1]
+
+    rr, cc_ = np.indices(cc.shape)
+    row_sums = np.bincount(flat, weights=rr.ravel(), minlength=n_comps + 1)[1:n_comps + 1]
+    col_sums = np.bincount(flat, weights=cc_.ravel(), minlength=n_comps + 1)[1:n_comps + 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid = np.stack((row_sums / area, col_sums / area), axis=1)
+
+    bbox = np.zeros((n_comps, 4), dtype=np.int64)
+    for i, sl in enumerate(ndimage.find_objects(cc, max_label=n_comps)):
+        if sl is not None:
+            bbox[i] = sl[0].start, sl[1].start, sl[0].stop, sl[1].stop
+
+    stats = {
+        'label': labels,
+        'area': area,
+        'centroid': centroid,
+        'bbox': bbox,
+        'perimeter': np.full((n_comps,), np.nan),
+        'circularity': np.full((n_comps,), np.nan),
+    }
+    if perimeter:
+        add_region_perimeters(stats, cc)
+    return stats
+
+
+def select_regions(stats: dict, min_area: float, max_area: float, min_circularity: float = 0.) -> np.ndarray:
+    """Return a boolean mask of regions that pass the size and circularity filters.
+
+    A min_circularity of 0 disables circularity filtering (which is the only
+    filter that requires perimeters)."""
+    area = stats['area']
+    area_ok = (area >= min_area) & (area <= max_area)
+    valid = area_ok
+    if min_circularity > 0:
+        circularity_ok = stats['circularity'] >= min_circularity
+        # NaN circularity (can't happen for non-empty regions) is not rejected, as in a scalar `circularity < min` check
+        circularity_ok |= np.isnan(stats['circularity'])
+        valid = area_ok & circularity_ok
+        logger.info(f'Skipping {np.sum(area_ok & ~circularity_ok)} regions with circularity below {min_circularity}')
+    logger.info(f'Skipping {np.sum(~area_ok)} regions with area size not within [{min_area}, {max_area}]')
+    return valid
+
+
+def relabel_regions(cc: np.ndarray, n_comps: int, region_indices: np.ndarray, values: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    """Map each region of the label image cc to a new value with one lookup table gather.
+
+    Region region_indices[k] (label region_indices[k] + 1) is mapped to values[k].
+    All other regions and the background are mapped to 0."""
+    lut = np.zeros((n_comps + 1,), dtype=dtype)
+    lut[np.asarray(region_indices, dtype=np.int64) + 1] = values
+    return lut[cc]
+
+
+def match_instances(pred_cc: np.ndarray, n_pred: int, gt_cc: np.ndarray, n_gt: int, iou_threshold: float = 0.5) -> dict:
+    """Match predicted to ground truth connected components by their IoU.
+
+    Overlaps are computed sparsely with one np.unique over the label pairs of pixels
+    where both label images are foreground, so only actually overlapping pairs are considered.
+    Matching is one-to-one: pairs with IoU > iou_threshold are assigned greedily by descending IoU,
+    skipping pairs whose components are already matched. With iou_threshold >= 0.5, every component
+    has at most one such pair anyway, so the assignment is unique.
+
+    Returns a dict with the matched (pred_label, gt_label) pairs, their IoUs and the
+    numbers of matched, missed (unmatched GT) and spurious (unmatched predicted) components."""
+    fg = (pred_cc > 0) & (gt_cc > 0)
+    pair_codes, intersections = np.unique(
+        pred_cc[fg].astype(np.int64) * (n_gt + 1) + gt_cc[fg], return_counts=True
+    )
+    pred_labels, gt_labels = np.divmod(pair_codes, n_gt + 1)
+    pred_areas = np.bincount(pred_cc.ravel(), minlength=n_pred + 1)
+    gt_areas = np.bincount(gt_cc.ravel(), minlength=n_gt + 1)
+    ious = intersections / (pred_areas[pred_labels] + gt_areas[gt_labels] - intersections)
+    candidates = np.flatnonzero(ious > iou_threshold)
+    candidates = candidates[np.argsort(-ious[candidates], kind='stable')]
+    is_match = np.zeros(ious.shape, dtype=bool)
+    pred_matched = np.zeros((n_pred + 1,), dtype=bool)
+    gt_matched = np.zeros((n_gt + 1,), dtype=bool)
+    for i in candidates:
+        if not (pred_matched[pred_labels[i]] or gt_matched[gt_labels[i]]):
+            is_match[i] = pred_matched[pred_labels[i]] = gt_matched[gt_labels[i]] = True
+    n_matched = int(np.sum(is_match))
+    return {
+        'pred_labels': pred_labels[is_match],
+        'gt_labels': gt_labels[is_match],
+        'ious': ious[is_match],
+        'n_pred': n_pred,
+        'n_gt': n_gt,
+        'n_matched': n_matched,
+        'n_missed': n_gt - n_matched,
+        'n_spurious': n_pred - n_matched,
+    }
+
+
+def windows_inside(centers: np.ndarray, radius: int, shape: tuple, odd_plus1: int = 1) -> np.ndarray:
+    """Return a boolean mask of the (N, 2) centers whose patch windows lie completely inside an image of the given shape"""
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    lo = centers - radius
+    hi = centers + radius + odd_plus1
+    return np.all(lo >= 0, axis=1) & np.all(hi <= np.array(shape[:2]), axis=1)
+
+
+def extract_patches(image: np.ndarray, centers: np.ndarray, radius: int, odd_plus1: int = 1, pad_mode: str | None = None) -> np.ndarray:
+    """Gather the square windows around all (N, 2) integer centers of a 2D image into one contiguous (N, W, W) stack.
+
+    The window around a center c covers [c - radius, c + radius + odd_plus1) in each dimension,
+    so W = 2 * radius + odd_plus1.
+
+    pad_mode determines how windows that extend beyond the image border are handled:
+
+    - None: no padding. All windows must lie completely inside the image (see windows_inside())
+    - 'constant': pixels outside of the image are 0
+    - 'reflect': the image is mirrored at its border (see np.pad)
+    """
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    width = 2 * radius + odd_plus1
+    if len(centers) == 0:
+        return np.empty((0, width, width), dtype=image.dtype)
+    if pad_mode is None:
+        if not np.all(windows_inside(centers, radius, image.shape, odd_plus1)):
+            raise ValueError('Some patch windows extend beyond the image border. Use pad_mode or filter centers with windows_inside().')
+        padded = image
+        offset = 0
+    elif pad_mode in ['constant', 'reflect']:
+        padded = np.pad(image, ((radius, radius + odd_plus1), (radius, radius + odd_plus1)), mode=pad_mode)
+        offset = radius
+    else:
+        raise ValueError(f'Unknown pad_mode {pad_mode}')
+    lo = centers - radius + offset
+    # Strided (H', W', width, width) view of all windows, fancy indexing copies the selected ones into a new array
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (width, width))
+    return windows[lo[:, 0], lo[:, 1]]
+
+
+def isolate_center_masks(label_patches: np.ndarray, bboxes: np.ndarray, corners: np.ndarray) -> np.ndarray:
+    """Isolate the particle mask at the center pixel of each patch in an (N, H, W) stack of global label patches.
+
+    Equivalent to labeling each binary patch (label_patch > 0) locally and keeping only the
+    component that contains the center pixel, but without labeling every patch:
+    Different global labels are never 4-connected, so the local component is the set of pixels
+    that share the global label of the center pixel. Only if that region is not completely inside
+    the patch window (it could then fall apart into multiple local components), it is labeled locally.
+
+    bboxes are the global region bounding boxes (see compute_region_stats()), indexed by label - 1.
+    corners are the (N, 2) global coordinates of the patch origins (can be negative for padded patches).
+    Patches with background at the center pixel get empty masks."""
+    n, h, w = label_patches.shape
+    # Assuming convex particles, the center pixel is always on the actual mask region of interest.
+    local_center = np.round(np.array((h, w)) / 2).astype(np.int64)
+    center_labels = label_patches[:, local_center[0], local_center[1]]
+    masks = label_patches == center_labels[:, None, None]
+    masks[center_labels == 0] = False
+
+    corners = np.asarray(corners, dtype=np.int64).reshape(-1, 2)
+    fg = np.flatnonzero(center_labels > 0)
+    rbboxes = bboxes[center_labels[fg] - 1]
+    lo = rbboxes[:, :2] - corners[fg]
+    hi = rbboxes[:, 2:] - corners[fg]
+    inside = np.all(lo >= 0, axis=1) & (hi[:, 0] <= h) & (hi[:, 1] <= w)
+    for k in fg[~inside]:
+        _mask_cc, _ = ndimage.label(masks[k])
+        masks[k] = _mask_cc == _mask_cc[tuple(local_center)]
+    return masks
+
+
+@lru_cache(maxsize=8)
+def _disk_footprint_3d(radius: int) -> np.ndarray:
+    return sm.disk(radius).astype(bool)[None]
+
+
+def dilate_masks(masks: np.ndarray, radius: int) -> np.ndarray:
+    """Dilate all masks of an (N, H, W) stack with a disk footprint at once.
+
+    Same result as sm.binary_dilation(mask, footprint=sm.disk(radius)) on each mask,
+    because the (1, k, k) footprint does not connect different masks of the stack."""
+    if radius <= 0:
+        return masks.copy()
+    return ndimage.binary_dilation(masks, structure=_disk_footprint_3d(radius))
+
+
+class RegionChunk(NamedTuple):
+    """Patch stacks and measurements of a chunk of regions, see iter_region_chunks().
+
+    Each field is an array with one entry per region."""
+    index: np.ndarray  # Region indices (label - 1) in the label image
+    centroid: np.ndarray  # (N, 2) rounded centroids in the global coordinate frame
+    corner: np.ndarray  # (N, 2) global coordinates of the patch origins (can be negative for padded patches)
+    raw_patch: np.ndarray
+    mask_patch: np.ndarray  # Isolated particle masks
+    dilated_mask_patch: np.ndarray
+    nobg_patch: np.ndarray  # Raw patches with background (outside of dilated mask) erased
+    area: np.ndarray
+    area_dilated: np.ndarray
+    radius2: np.ndarray
+    radius2_dilated: np.ndarray
+    circularity: np.ndarray  # NaN if circularity filtering is disabled
+    class_id: np.ndarray | None = None
+    class_probs: np.ndarray | None = None
+
+
+def select_candidate_regions(
+        cc: np.ndarray,
+        n_comps: int,
+        min_area: float,
+        max_area: float,
+        min_circularity: float = 0.,
+        ec_region_radius: int = 24,
+        odd_plus1: int = 1,
+        border_mode: str | None = None,
+) -> tuple[dict, np.ndarray]:
+    """Compute region stats and select the regions that should be patchified.
+
+    Regions are rejected by size, circularity and, if border_mode is None, if their
+    patch window extends beyond the image border.
+    Perimeters are only measured for regions that pass the size filter.
+
+    Returns the region stats (see compute_region_stats()) and the indices of the selected regions."""
+    rstats = compute_region_stats(cc, n_comps, perimeter=False)
+    if min_circularity > 0:
+        add_region_perimeters(rstats, cc, (rstats['area'] >= min_area) & (rstats['area'] <= max_area))
+    is_candidate = select_regions(rstats, min_area=min_area, max_area=max_area, min_circularity=min_circularity)
+    if border_mode is None:
+        centroids = np.round(rstats['centroid']).astype(np.int64)
+        inside = windows_inside(centroids, ec_region_radius, cc.shape, odd_plus1)
+        logger.info(f'Skipping {np.sum(is_candidate & ~inside)} regions that touch the border')  # Too close to image border
+        is_candidate &= inside
+    return rstats, np.flatnonzero(is_candidate)
+
+
+def iter_region_chunks(
+        raw: np.ndarray,
+        cc: np.ndarray,
+        rstats: dict,
+        region_indices: np.ndarray,
+        ec_region_radius: int = 24,
+        odd_plus1: int = 1,
+        dilate_masks_by: int = 5,
+        border_mode: str | None = None,
+        classify_fn: Callable[[np.ndarray], tuple[np.ndarray, np.ndarray]] | None = None,
+        chunk_size: int = 256,
+) -> Iterator[RegionChunk]:
+    """Patchify, measure and optionally classify regions of a label image in chunks of at most chunk_size regions.
+
+    This is the region pipeline that is shared by compute_rprops() and patchifyseg.
+    Only one chunk of patch stacks is held in memory at a time, regardless of the
+    number of regions in the image.
+
+    region_indices are usually obtained with select_candidate_regions().
+    classify_fn receives the (n, H, W) stack of background-erased patches and returns
+    class ids and class probabilities, e.g.
+    functools.partial(inference_utils.classify_patches, classifier_variant=..., return_probs=True).
+    Regions without a particle mask at the patch center are dropped."""
+    label_pad_mode = None if border_mode is None else 'constant'
+    for start in range(0, len(region_indices), chunk_size):
+        indices = np.asarray(region_indices[start:start + chunk_size])
+        centroids = np.round(rstats['centroid'][indices]).astype(np.int64)  # Note: These centroids are in the global coordinate frame
+        corners = centroids - ec_region_radius
+
+        # Label patches are always zero-padded, so regions never extend into the padding.
+        # (Masks are rebuilt from cc because for some reason mask[xslice, yslice] does not always contain nonzero values)
+        raw_patches = extract_patches(raw, centroids, ec_region_radius, odd_plus1, pad_mode=border_mode)
+        label_patches = extract_patches(cc, centroids, ec_region_radius, odd_plus1, pad_mode=label_pad_mode)
+
+        # Eliminate coinciding masks from other particles that can overlap with this region (this can happen because we slice the mask_patch from the global mask)
+        mask_patches = isolate_center_masks(label_patches, rstats['bbox'], corners)
+
+        has_mask = mask_patches.any(axis=(1, 2))
+        if not np.all(has_mask):
+            # No positive pixel in mask -> skip these
+            logger.info(f'Skipping {np.sum(~has_mask)} regions with no particle mask in region')
+            # TODO: Why does this happen although we're iterating over regions from the label image?
+            indices, centroids, corners = indices[has_mask], centroids[has_mask], corners[has_mask]
+            raw_patches, mask_patches = raw_patches[has_mask], mask_patches[has_mask]
+
+        # Enlarge masks because we don't want to risk losing perimeter regions
+        dilated_mask_patches = dilate_masks(mask_patches, dilate_masks_by)
+
+        # Raw patches with background erased via mask
+        nobg_patches = np.where(dilated_mask_patches, raw_patches, 0).astype(raw_patches.dtype)
+
+        class_ids, class_probs = (None, None) if classify_fn is None else classify_fn(nobg_patches)
+
+        yield RegionChunk(
+            index=indices,
+            centroid=centroids,
+            corner=corners,
+            raw_patch=raw_patches,
+            mask_patch=mask_patches,
+            dilated_mask_patch=dilated_mask_patches,
+            nobg_patch=nobg_patches,
+            area=mask_patches.sum(axis=(1, 2)),
+            area_dilated=dilated_mask_patches.sum(axis=(1, 2)),
+            radius2=np.round(measure_outer_disk_radii(mask_patches, discrete=False), 1),
+            radius2_dilated=np.round(measure_outer_disk_radii(dilated_mask_patches, discrete=False), 1),
+            circularity=np.round(rstats['circularity'][indices], 2),
+            class_id=class_ids,
+            class_probs=class_probs,
+        )
+
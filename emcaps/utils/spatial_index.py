@@ -0,0 +1,131 @@
+"""
+Spatial index over region tables (as produced by compute_rprops()).
+
+Region centroids are indexed in a KD-tree, which supports fast radius, box,
+k-nearest-neighbour and point-under-cursor queries as well as duplicate
+suppression when merging region tables of overlapping tiles.
+"""
+
+import logging
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+logger = logging.getLogger('emcaps-spatial-index')
+
+
+def _table_columns(table, prefix: str, n: int) -> np.ndarray:
+    return np.stack([np.asarray(table[f'{prefix}-{i}'], dtype=np.float64) for i in range(n)], axis=1)
+
+
+class RegionIndex:
+    """KD-tree index over (N, 2) region centroids (row, column) with optional (N, 4) bounding boxes
+    (min_row, min_col, max_row, max_col).
+
+    All queries return integer positions into the indexed region table, in ascending order."""
+    def __init__(self, centroids: np.ndarray, bboxes: np.ndarray | None = None, leafsize: int = 32):
+        self.centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        self.bboxes = None if bboxes is None else np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.tree = cKDTree(self.centroids, leafsize=leafsize)
+        # Largest distance between a centroid and a corner of its bbox (bounds the search radius of point queries)
+        if self.bboxes is not None and len(self.bboxes) > 0:
+            extents = np.maximum(self.centroids - self.bboxes[:, :2], self.bboxes[:, 2:] - self.centroids)
+            self._max_extent = float(np.max(extents))
+        else:
+            self._max_extent = 0.
+
+    @classmethod
+    def from_properties(cls, properties, leafsize: int = 32) -> 'RegionIndex':
+        """Build an index from a region table (dict of arrays or DataFrame) with centroid-0/1 and optionally bbox-0..3 columns"""
+        centroids = _table_columns(properties, 'centroid', 2)
+        bboxes = _table_columns(properties, 'bbox', 4) if 'bbox-0' in properties else None
+        return cls(centroids, bboxes=bboxes, leafsize=leafsize)
+
+    def __len__(self) -> int:
+        return self.centroids.shape[0]
+
+    def query_radius(self, point, radius: float) -> np.ndarray:
+        """Regions whose centroids are within radius of point"""
+        return np.sort(np.asarray(self.tree.query_ball_point(point, radius), dtype=np.int64))
+
+    def query_box(self, lo, hi) -> np.ndarray:
+        """Regions whose centroids are inside the box [lo, hi) (row, column)"""
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        # Chebyshev ball around the box center covers the whole box, then filter exactly
+        candidates = self.query_radius_inf((lo + hi) / 2, float(np.max(hi - lo)) / 2)
+        c = self.centroids[candidates]
+        inside = np.all((c >= lo) & (c < hi), axis=1)
+        return candidates[inside]
+
+    def query_radius_inf(self, point, radius: float) -> np.ndarray:
+        """Regions whose centroids are within radius of point in the maximum norm"""
+        return np.sort(np.asarray(self.tree.query_ball_point(point, radius, p=np.inf), dtype=np.int64))
+
+    def query_knn(self, points, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """Distances and positions of the k nearest regions of each point (see cKDTree.query)"""
+        return self.tree.query(points, k=k)
+
+    def query_point(self, point) -> np.ndarray:
+        """Regions whose bounding boxes contain point, e.g. the particle under the cursor"""
+        if self.bboxes is None:
+            raise ValueError('Point queries require bounding boxes')
+        point = np.asarray(point, dtype=np.float64)
+        candidates = self.query_radius_inf(point, self._max_extent)
+        b = self.bboxes[candidates]
+        inside = np.all((point >= b[:, :2]) & (point < b[:, 2:]), axis=1)
+        return candidates[inside]
+
+    def find_duplicates(self, min_distance: float, priority: np.ndarray | None = None) -> np.ndarray:
+        """Return a boolean mask of regions that duplicate another region.
+
+        Greedy non-maximum suppression: Regions are visited in order of descending priority
+        (default: table position, ties are also broken by table position) and a region is kept
+        only if no already kept region is within min_distance. So a region is never dropped
+        because of a region that was dropped itself."""
+        n = len(self)
+        if priority is None:
+            priority = -np.arange(n)
+        order = np.argsort(-np.asarray(priority), kind='stable')
+        duplicates = np.zeros((n,), dtype=bool)
+        for i in order:
+            if duplicates[i]:
+                continue
+            # i is kept, so all lower priority regions close to it are duplicates
+            neighbors = np.asarray(self.tree.query_ball_point(self.centroids[i], min_distance), dtype=np.int64)
+            duplicates[neighbors] = True
+            duplicates[i] = False
+        return duplicates
+
+
+def merge_region_tables(
+        tables: Sequence,
+        offsets: Sequence[tuple[int, int]],
+        min_distance: float = 5.,
+        priority_column: str | None = 'area',
+) -> pd.DataFrame:
+    """Merge region tables of (overlapping) image tiles into one table in global coordinates.
+
+    Centroid and bbox columns of each table are shifted by the (row, column) offset of its tile.
+    Regions that were found in more than one tile (centroids closer than min_distance) are
+    only kept once, preferring the one with the highest priority_column value."""
+    frames = []
+    for table, offset in zip(tables, offsets, strict=True):
+        frame = pd.DataFrame(table).copy()
+        for i in range(2):
+            frame[f'centroid-{i}'] = frame[f'centroid-{i}'] + offset[i]
+            for j in (i, i + 2):
+                if f'bbox-{j}' in frame:
+                    frame[f'bbox-{j}'] = frame[f'bbox-{j}'] + offset[i]
+        frames.append(frame)
+    merged = pd.concat(frames, ignore_index=True)
+    if len(merged) == 0:
+        return merged
+    index = RegionIndex.from_properties(merged)
+    priority = None if priority_column is None else merged[priority_column].to_numpy()
+    duplicates = index.find_duplicates(min_distance, priority=priority)
+    logger.info(f'Dropping {np.sum(duplicates)} duplicate regions at tile seams')
+    return merged.loc[~duplicates].reset_index(drop=True)
@@ -93,6 +93,44 @@ def get_default_sheet_path(prefix: str | Path) -> Path:
     return get_path_prefix(prefix) / 'emcapsulin' / 'emcapsulin_data.xlsx'
 
 
+def resolve_table_path(path: Path | str) -> Path:
+    """Find the file of a table written by write_table(), preferring Parquet over XLSX.
+
+    For path 'x.xlsx' or 'x.parquet', return 'x.parquet' if it exists, else 'x.xlsx' if it exists, else path."""
+    path = Path(path).expanduser()
+    for candidate in [path.with_suffix('.parquet'), path.with_suffix('.xlsx')]:
+        if candidate.is_file():
+            return candidate
+    return path
+
+
+def read_table(path: Path | str, index_col: Optional[int] = None) -> pd.DataFrame:
+    """Read a (patch or region) table from Parquet or XLSX, see resolve_table_path().
+
+    If index_col is None, the stored index (e.g. patch_id) is returned as a regular column, like pd.read_excel() does."""
+    path = resolve_table_path(path)
+    if path.suffix == '.parquet':
+        table = pd.read_parquet(path)
+        if index_col is None and table.index.name is not None:
+            table = table.reset_index()
+        return table
+    return pd.read_excel(path, 0, index_col=index_col)
+
+
+def write_table(table: pd.DataFrame, path: Path | str, index_label: Optional[str] = None, xlsx_export: bool = False) -> Path:
+    """Write a table as Parquet file (same path, but with .parquet suffix) and optionally also as XLSX file for human inspection.
+
+    The index is only stored if index_label is given. Returns the path of the Parquet file."""
+    path = Path(path).expanduser()
+    pq_path = path.with_suffix('.parquet')
+    if index_label is not None:
+        table = table.rename_axis(index_label)
+    table.to_parquet(pq_path, index=index_label is not None)
+    if xlsx_export:
+        table.to_excel(path.with_suffix('.xlsx'), index=index_label is not None, index_label=index_label)
+    return pq_path
+
+
 # TODO: All functions requiring a sheet_path could be refactored into methods
 #       of a "Sheet" class that knows where the sheet is located
 @lru_cache(maxsize=8192)
@@ -160,33 +198,60 @@ def get_complex_enctype(path_or_num: Path | str | int, sheet_path: Path | str) -
     return enctype
 
 
-@lru_cache(maxsize=8192)
 def get_isplit_enctype(path, sheet_path: Path | str, pos: Optional[Tuple[int]] = None, isplitdata_root=None, role=None) -> str:
+    if pos is None:
+        return get_isplit_enctypes(path, sheet_path=sheet_path)[0]
+    return get_isplit_enctypes(path, sheet_path=sheet_path, positions=np.array([pos]), isplitdata_root=isplitdata_root, role=role)[0]
+
+
+def get_isplit_enctypes(path, sheet_path: Path | str, positions: Optional[np.ndarray] = None, isplitdata_root=None, role=None) -> np.ndarray:
+    """Vectorized version of get_isplit_enctype() that looks up the enctypes at all (N, 2) positions of one image at once.
+
+    Returns an array of N enctype names (just one if positions is None)."""
+    n = 1 if positions is None else len(positions)
     row = get_meta_row(path, sheet_path=sheet_path)
     enctype = row['Enc Type']
-    if enctype in CLASS_GROUPS['simple_hek'] or pos is None:
+    if enctype in CLASS_GROUPS['simple_hek'] or positions is None:
         # 1. If enctype is simple (no combination), the enctype is already known from the image metadata.
-        # 2. If no pos is supplied, just one type is expected (position-independent).
-        return enctype
+        # 2. If no positions are supplied, just one type is expected (position-independent).
+        return np.full((n,), enctype, dtype=object)
 
-    # Else (complex case): find specific enctype of encapsulin at position pos
+    # Else (complex case): find specific enctypes of encapsulins at positions
     assert isplitdata_root is not None
     assert role is not None
-    # Prefer region masks because they cover more area
-    elabs = get_isplit_per_enctype_regmasks(img_num=row.num, isplitdata_root=isplitdata_root)[role]
-    if not elabs:  # No regmask found -> Look for enctype-specific label map instead
-        elabs = get_isplit_per_enctype_labels(img_num=row.num, isplitdata_root=isplitdata_root)[role]
-        if not elabs:  # Still nothing found
-            return '?'
-    # Masks or labels found -> Get enctype at pos
-    # enctype_at_pos = scondv5
-    enctype_at_pos = '?'
-    for enctype, elab in elabs.items():
-        if elab[pos] > 0:
-            enctype_at_pos = enctype
+    index_map, enctype_names = get_isplit_enctype_index_map(img_num=row.num, isplitdata_root=isplitdata_root, role=role)
+    if index_map is None:  # No regmask or label found
+        return np.full((n,), '?', dtype=object)
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    lut = np.array(('?',) + enctype_names, dtype=object)
+    return lut[index_map[positions[:, 0], positions[:, 1]]]
+
+
+@lru_cache(maxsize=16)
+def get_isplit_enctype_index_map(img_num: int, isplitdata_root: Path, role: str) -> Tuple[Optional[np.ndarray], Tuple[str, ...]]:
+    """Build a uint8 map that holds the enctype index at each pixel of an image, 0 meaning unknown ('?').
+
+    Index i > 0 refers to the enctype name at position i - 1 of the returned enctype name tuple.
+    Per-enctype region masks are preferred because they cover more area, enctype-specific label maps
+    are used as a fallback. Where masks overlap, the first enctype (in CLASS_NAMES order) wins, like
+    in the per-mask lookup that this replaces. Returns (None, ()) if no mask or label is found."""
+    ipath = Path(isplitdata_root) / f'{img_num}'
+    for kind in ['mask', 'elab']:  # Prefer region masks
+        epaths = {scond: ipath / f'{img_num}_{role}_{kind}_{scond}.png' for scond in CLASS_NAMES.values()}
+        epaths = {scond: epath for scond, epath in epaths.items() if epath.is_file()}
+        if epaths:
             break
-
-    return enctype_at_pos
+    else:
+        return None, ()
+    enctype_names = tuple(epaths.keys())
+    index_map = None
+    # Fill in reverse order so that earlier enctypes overwrite later ones where they overlap
+    for i in reversed(range(len(enctype_names))):
+        emask = iio.imread(epaths[enctype_names[i]]) > 0
+        if index_map is None:
+            index_map = np.zeros(emask.shape, dtype=np.uint8)
+        index_map[emask] = i + 1
+    return index_map, enctype_names
 
 
 @lru_cache(maxsize=8192)
@@ -334,35 +399,6 @@ class ImageResources:
 #                 region_masks[role][scond] = rmask
 #     return region_masks
 
-@lru_cache(maxsize=8192)
-def get_isplit_per_enctype_labels(img_num: int, isplitdata_root: Path) -> Dict[str, Dict[str, np.ndarray]]:
-    elabs = {'trn': {}, 'val': {}}
-    ipath = isplitdata_root / f'{img_num}'
-    for role in ['trn', 'val']:
-        for scond in CLASS_NAMES.values():
-            epath = ipath / f'{img_num}_{role}_elab_{scond}.png'
-            if epath.is_file():
-                rmask = iio.imread(epath) > 0
-                elabs[role][scond] = rmask
-    return elabs
-
-
-@lru_cache(maxsize=8192)
-def get_isplit_per_enctype_regmasks(img_num: int, isplitdata_root: Path) -> Dict[str, Dict[str, np.ndarray]]:
-    rmasks = {'trn': {}, 'val': {}}
-    ipath = isplitdata_root / f'{img_num}'
-    for role in ['trn', 'val']:
-        for scond in CLASS_NAMES.values():
-            rpath = ipath / f'{img_num}_{role}_mask_{scond}.png'
-            if rpath.is_file():
-                rmask = iio.imread(rpath) > 0
-                rmasks[role][scond] = rmask
-    return rmasks
-
-# @lru_cache(maxsize=8192)
-# def get_isplit_per_enctype_regmasks_or_labels(img_num: int, isplitdata_root: Path):
-#     regmasks = get_isplit_per_enctype_regmasks(img_num=img_num, isplitdata_root=isplitdata_root)
-
 
 def strip_host_prefix(enctype: str, host_prefixes=('DRO-', 'MICE_')) -> str:
     """drop DRO, MICE because we want to treat DRO amd MICE the same class as HEK in most cases"""
@@ -0,0 +1,30 @@
+import numpy as np
+
+from emcaps.utils.region_utils import match_instances
+
+
+def test_match_instances_is_one_to_one_at_low_threshold():
+    # One predicted component overlaps two GT components and vice versa
+    pred_cc = np.zeros((10, 20), dtype=np.int32)
+    gt_cc = np.zeros((10, 20), dtype=np.int32)
+    pred_cc[2:8, 2:10] = 1
+    pred_cc[2:8, 12:14] = 2
+    gt_cc[2:8, 2:6] = 1
+    gt_cc[2:8, 6:14] = 2
+    m = match_instances(pred_cc, 2, gt_cc, 2, iou_threshold=0.)
+    assert m['n_matched'] == 2
+    assert m['n_missed'] == 0 and m['n_spurious'] == 0
+    assert len(set(m['pred_labels'])) == len(m['pred_labels'])
+    assert len(set(m['gt_labels'])) == len(m['gt_labels'])
+    # The highest-IoU pair (pred 1, GT 1: 24 / 48) is matched first, then pred 2 and GT 2
+    assert sorted(zip(m['pred_labels'].tolist(), m['gt_labels'].tolist())) == [(1, 1), (2, 2)]
+
+
+def test_match_instances_never_reports_negative_counts():
+    rng = np.random.default_rng(0)
+    pred_cc = rng.integers(0, 6, (40, 40))
+    gt_cc = rng.integers(0, 4, (40, 40))
+    for threshold in [0., 0.1, 0.3, 0.5]:
+        m = match_instances(pred_cc, 5, gt_cc, 3, iou_threshold=threshold)
+        assert m['n_missed'] >= 0 and m['n_spurious'] >= 0
+        assert m['n_matched'] <= min(5, 3)
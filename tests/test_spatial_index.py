@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from emcaps.utils.spatial_index import RegionIndex, merge_region_tables
+
+
+def test_find_duplicates_keeps_regions_next_to_dropped_ones():
+    # Region 1 is a duplicate of region 0, region 2 is only close to region 1 (which is dropped)
+    index = RegionIndex(np.array([[0, 0], [4, 0], [8, 0]]))
+    duplicates = index.find_duplicates(5., priority=np.array([3, 2, 1]))
+    assert duplicates.tolist() == [False, True, False]
+
+
+def test_find_duplicates_prefers_higher_priority():
+    index = RegionIndex(np.array([[0, 0], [3, 0], [20, 20]]))
+    assert index.find_duplicates(5., priority=np.array([1, 2, 0])).tolist() == [True, False, False]
+    # By default, the earlier region is kept
+    assert index.find_duplicates(5.).tolist() == [False, True, False]
+
+
+def test_query_box():
+    index = RegionIndex(np.array([[1, 1], [5, 5], [9, 2], [5, 10]]))
+    assert index.query_box((0, 0), (6, 6)).tolist() == [0, 1]
+    assert index.query_box((0, 0), (5, 5)).tolist() == [0]  # hi is exclusive
+    assert index.query_box((4, 0), (10, 11)).tolist() == [1, 2, 3]
+
+
+def test_query_knn():
+    index = RegionIndex(np.array([[0, 0], [10, 0], [0, 3]]))
+    dists, positions = index.query_knn(np.array([[1, 0], [9, 0]]), k=2)
+    assert positions.tolist() == [[0, 2], [1, 0]]
+    np.testing.assert_allclose(dists[0], [1, np.sqrt(10)])
+
+
+def test_query_point():
+    centroids = np.array([[5, 5], [20, 20]])
+    bboxes = np.array([[0, 0, 10, 10], [15, 15, 25, 25]])
+    index = RegionIndex(centroids, bboxes=bboxes)
+    assert index.query_point((9, 1)).tolist() == [0]
+    assert index.query_point((12, 12)).tolist() == []
+
+
+def _table(centroids, areas):
+    centroids = np.asarray(centroids, dtype=np.float64)
+    return pd.DataFrame({
+        'centroid-0': centroids[:, 0], 'centroid-1': centroids[:, 1],
+        'bbox-0': centroids[:, 0] - 2, 'bbox-1': centroids[:, 1] - 2,
+        'bbox-2': centroids[:, 0] + 2, 'bbox-3': centroids[:, 1] + 2,
+        'area': areas,
+    })
+
+
+def test_merge_region_tables_shifts_and_deduplicates_at_seams():
+    # Two tiles of width 100 with an overlap of 20: tile b starts at column 80
+    a = _table([[10, 10], [50, 90]], areas=[30, 20])
+    b = _table([[50, 11], [70, 50]], areas=[40, 25])  # First region is the one at (50, 91) in global coords
+    merged = merge_region_tables([a, b], offsets=[(0, 0), (0, 80)], min_distance=5.)
+    assert len(merged) == 3
+    assert merged[['centroid-0', 'centroid-1']].to_numpy().tolist() == [[10, 10], [50, 91], [70, 130]]
+    assert merged['area'].tolist() == [30, 40, 25]  # Larger area wins at the seam
+    assert merged['bbox-1'].tolist() == [8, 89, 128]
+
+
+def test_merge_region_tables_empty():
+    assert len(merge_region_tables([_table(np.zeros((0, 2)), [])], offsets=[(0, 0)])) == 0